@@ -8,6 +8,11 @@ from collections import defaultdict
 from tqdm import tqdm
 import random
 import time
+import json
+import glob
+import re
+import hashlib
+import numbers
 
 
 # source_lang_file = "German_sentences.pkl"
@@ -15,143 +20,807 @@ import time
 source_lang_file = "English_sentences.pkl"
 dest_lang_file  = "German_sentences.pkl"
 DIR = os.path.dirname(os.path.realpath(__file__))
+LANG_FILES = {"german":dest_lang_file,"english":source_lang_file}
+### split rule the corpus was tokenized with: every non-word char and digit
+### is its own token, and the empty strings between them are kept
+TOKEN_RE = re.compile(r'(\W|\d)')
+
+def memmap_prefix(fn):
+    return fn[:-len('.pkl')] if fn.endswith('.pkl') else fn
+
+def convert_to_memmap(fn,pad=1):
+    '''
+    One-time conversion of a pickled sentence list into
+        {prefix}.train.npy  (N_train, W) fixed-width token ids
+        {prefix}.test.npy   (N_test,  W)
+        {prefix}.{split}.tokens.npy   all sentences of a split concatenated
+        {prefix}.{split}.offsets.npy  (N+1,) start of each sentence in tokens
+        {prefix}.vocab.json vocab tables and metadata
+    W is the longest sentence, rows are padded with token `pad`.
+    int16 is used whenever the vocabulary fits.
+    '''
+    load = torch.load(fn)
+    prefix = memmap_prefix(fn)
+    W = max(len(x) for k in ['train_data','test_data'] for x in load[k])
+    dtype = np.int16 if load['vocab_len'] < np.iinfo(np.int16).max else np.int32
+    for split in ['train','test']:
+        xx  = load[split+'_data']
+        out = np.lib.format.open_memmap(f'{prefix}.{split}.npy',mode='w+',dtype=dtype,shape=(len(xx),W))
+        out[:] = pad
+        for i,x in enumerate(xx):
+            out[i,:len(x)] = x.numpy()
+        out.flush()
+        del out
+        offsets = np.cumsum([0]+[len(x) for x in xx]).astype(np.int64)
+        np.save(f'{prefix}.{split}.offsets.npy',offsets)
+        np.save(f'{prefix}.{split}.tokens.npy',torch.cat(xx,dim=0).numpy().astype(dtype))
+    write_vocab_json(load,prefix,width=W,pad=pad,dtype=np.dtype(dtype).name)
+    return prefix
+
+def write_vocab_json(load,prefix,**meta):
+    ### keeps keys written by the other converter
+    if os.path.exists(f'{prefix}.vocab.json'):
+        with open(f'{prefix}.vocab.json','r') as f:
+            meta = dict(json.load(f),**meta)
+    meta.update(
+        max_len        = load['max_len'],
+        min_len        = load['min_len'],
+        vocab_len      = load['vocab_len'],
+        vocab          = dict(load['vocab']),
+        vocab_reversed = list(load['vocab_reversed']),
+        )
+    with open(f'{prefix}.vocab.json','w') as f:
+        json.dump(meta,f)
+
+def write_shards(fn,shard_size=100000,pad=1):
+    '''
+    Splits each split of a pickled sentence list into on-disk shards
+        {prefix}.{split}.shard{k:05d}.tokens.npy   concatenated sentences
+        {prefix}.{split}.shard{k:05d}.offsets.npy  (n+1,) sentence starts
+    plus the usual {prefix}.vocab.json, for ShardedSentenceStream
+    '''
+    load = torch.load(fn)
+    prefix = memmap_prefix(fn)
+    dtype = np.int16 if load['vocab_len'] < np.iinfo(np.int16).max else np.int32
+    for split in ['train','test']:
+        xx = load[split+'_data']
+        for k,i in enumerate(range(0,len(xx),shard_size)):
+            sub = xx[i:i+shard_size]
+            np.save(f'{prefix}.{split}.shard{k:05d}.offsets.npy',np.cumsum([0]+[len(x) for x in sub]).astype(np.int64))
+            np.save(f'{prefix}.{split}.shard{k:05d}.tokens.npy',torch.cat(sub,dim=0).numpy().astype(dtype))
+    write_vocab_json(load,prefix,pad=pad,dtype=np.dtype(dtype).name,shard_size=shard_size)
+    return prefix
+
+def load_memmap(fn):
+    '''
+    Opens the output of convert_to_memmap() without copying.
+    Returns a dict shaped like the pickle, with train_data/test_data
+    as (N,W) integer tensors backed by copy-on-write mappings so that
+    DataLoader workers share the same page-cache pages.
+    '''
+    prefix = memmap_prefix(fn)
+    with open(f'{prefix}.vocab.json','r') as f:
+        load = json.load(f)
+    for split in ['train','test']:
+        load[split+'_data'] = torch.from_numpy(np.load(f'{prefix}.{split}.npy',mmap_mode='c'))
+        load[split+'_tokens'] = torch.from_numpy(np.load(f'{prefix}.{split}.tokens.npy',mmap_mode='c'))
+        load[split+'_offsets'] = torch.from_numpy(np.load(f'{prefix}.{split}.offsets.npy'))
+    return load
+
+def gather_ragged(tokens,offsets,idx,pad=1):
+    '''
+    Gathers sentences idx out of flat storage, padded with `pad` to the
+    longest of them rather than to a corpus-wide width.
+    :type tokens:  shape of (T,)
+    :type offsets: shape of (N+1,)
+    :type idx:     shape of (B,)
+    Returns (x, lengths) of shapes (B, max(lengths)) and (B,)
+    '''
+    start   = offsets[idx]
+    lengths = offsets[idx+1] - start
+    L = int(lengths.max()) if len(idx) else 0
+    pos   = torch.arange(L,device=tokens.device)[None]
+    valid = pos < lengths[:,None]
+    pos   = (start[:,None] + pos).masked_fill(~valid,0)
+    x = tokens[pos].long().masked_fill(~valid,pad)
+    return x,lengths
+
 class EnglishToGermanDataset(torch.utils.data.Dataset):
-    def __init__(self,CUDA=False):
+    def __init__(self,CUDA=False,mmap=False,var_len=False,languages=("german","english")):
+        '''
+        :param mmap: read the fixed-width .npy files written by
+            convert_to_memmap() instead of unpickling and padding
+        :param var_len: keep sentences at their true length in flat
+            {lang}_tokens_{split} storage indexed by {lang}_offsets_{split},
+            instead of truncating/padding everything to min_len.
+            Batches are then padded only to their own longest sentence.
+        :param languages: sides loaded up front and returned by __getitem__.
+            The other side is loaded on first access to one of its
+            {lang}_* attributes.
+        '''
         super(EnglishToGermanDataset, self).__init__()
-        print("LOADING GERMAN SENTENCES")
-        load = torch.load(os.path.join(DIR,dest_lang_file))
-        self.german_sentences_train = load["train_data"]
-        self.german_sentences_test = load["test_data"]
-        self.german_max_len = load["max_len"]
-        self.german_min_len = load["min_len"]
-        self.german_vocab_len = load["vocab_len"]
-        self.german_vocab = load["vocab"]
-        self.german_vocab_reversed = load["vocab_reversed"]
-        self.german_eos = self.german_vocab["<end>"]
-        print("LOADING ENGLISH SENTENCES")
-        load = torch.load(os.path.join(DIR,source_lang_file))
-        self.english_sentences_train = load["train_data"]
-        self.english_sentences_test = load["test_data"]
-        self.english_max_len = load["max_len"]
-        self.english_min_len = load["min_len"]
-        self.english_vocab_len = load["vocab_len"]
-        self.english_vocab = load["vocab"]
-        self.english_vocab_reversed = load["vocab_reversed"]
         self.mode = "train"
-        self.english_eos = self.english_vocab["<end>"]
         # self.min_len = 30#min(self.german_min_len,self.english_min_len)
         self.min_len = 15#min(self.german_min_len,self.english_min_len)
         self.CUDA = CUDA
+        self.mmap = mmap
+        self.var_len = var_len
         self.device = torch.device('cuda:0' if CUDA else 'cpu')
-
-        ## truncate or pad to min_len
-        for k in ["english_sentences_train","english_sentences_test","german_sentences_test","german_sentences_train"]:
-            xx = getattr(self,k)
-            for i,x in enumerate(xx):
-                x = x[:self.min_len]
-                x = torch.cat([x,torch.tensor([1]*(self.min_len - len(x))).long()] ,dim=0)
-                xx[i] = x
-            y= torch.stack(xx,dim=0).to(self.device)
-            setattr(self,k,y)
+        self.languages = tuple(languages)
+        self._loaded = set()
+        for lang in self.languages:
+            self._load_language(lang,LANG_FILES[lang])
 
         # import pdb; pdb.set_trace()
 
+    def __getattr__(self,name):
+        ### only reached for missing attributes: load that language lazily
+        lang = name.split('_')[0]
+        loaded = self.__dict__.get('_loaded')
+        if loaded is None or lang not in LANG_FILES or lang in loaded:
+            raise AttributeError(name)
+        self._load_language(lang,LANG_FILES[lang])
+        return getattr(self,name)
+
+    def _load_language(self,lang,fn):
+        print(f"LOADING {lang.upper()} SENTENCES")
+        self._loaded.add(lang)
+        fn = os.path.join(DIR,fn)
+        load = load_memmap(fn) if self.mmap else torch.load(fn)
+        setattr(self,f"{lang}_max_len",  load["max_len"])
+        setattr(self,f"{lang}_min_len",  load["min_len"])
+        setattr(self,f"{lang}_vocab_len",load["vocab_len"])
+        setattr(self,f"{lang}_vocab",    load["vocab"])
+        setattr(self,f"{lang}_vocab_reversed",load["vocab_reversed"])
+        setattr(self,f"{lang}_eos",      load["vocab"]["<end>"])
+
+        for split in ["train","test"]:
+            xx = load[split+"_data"]
+            if self.mmap:
+                offsets = load[split+"_offsets"]
+            else:
+                offsets = torch.tensor([0]+[len(x) for x in xx]).cumsum(0)
+            lengths = offsets[1:] - offsets[:-1]
+            if self.var_len:
+                ### ragged storage, nothing truncated
+                tokens = load[split+"_tokens"] if self.mmap else torch.cat(xx,dim=0)
+                setattr(self,f"{lang}_tokens_{split}",tokens.to(self.device))
+                setattr(self,f"{lang}_offsets_{split}",offsets.to(self.device))
+                setattr(self,f"{lang}_lengths_{split}",lengths.to(self.device))
+                continue
+            setattr(self,f"{lang}_lengths_{split}",lengths.clamp(max=self.min_len).to(self.device))
+
+            ## truncate or pad to min_len
+            if self.mmap:
+                ### a view into the mapping, no copy unless too narrow.
+                ### It keeps the file's int16/int32 dtype, _get() casts to long
+                y = xx[:,:self.min_len]
+                if y.size(1) < self.min_len:
+                    y = F.pad(y.long(),(0,self.min_len-y.size(1)),value=1)
+            else:
+                for i,x in enumerate(xx):
+                    x = x[:self.min_len]
+                    x = torch.cat([x,torch.tensor([1]*(self.min_len - len(x))).long()] ,dim=0)
+                    xx[i] = x
+                y= torch.stack(xx,dim=0)
+            setattr(self,f"{lang}_sentences_{split}",y.to(self.device))
+
     def logit_to_sentence(self,logits,language="german"):
-        if(language=="german"):
-            vocab = self.german_vocab_reversed
-        else:
-            vocab = self.english_vocab_reversed
-        sentence = []
-        for l in logits:
-            idx = torch.argmax(l)
-            word = vocab[idx]
-            sentence.append(word)
-        return "".join(sentence)
+        return self.decode(logits[None],language)[0]
+
+    def vocab_table(self,language="english"):
+        '''
+        Cached object array of the reversed vocab, rebuilt if the vocab grew
+        (e.g. RefillDataset appending <mask>)
+        '''
+        vocab = getattr(self,f"{language}_vocab_reversed")
+        tables = self.__dict__.setdefault("_vocab_tables",{})
+        table = tables.get(language)
+        if table is None or len(table)!=len(vocab):
+            table = tables[language] = np.empty(len(vocab),dtype=object)
+            table[:] = vocab
+        return table
+
+    def decode(self,x,language="english",join=True):
+        '''
+        Batch detokenizer with a single argmax and a single take
+        :type x: shape of (B,L,V) logits or (B,L) token ids
+        Returns B strings, or the (B,L) object array of words if not join
+        '''
+        if x.is_floating_point() and x.dim()==3:
+            x = x.argmax(-1)
+        words = self.vocab_table(language).take(x.long().cpu().numpy())
+        if not join:
+            return words
+        return ["".join(w) for w in words.reshape((-1,words.shape[-1]))]
+
+    def encode(self,texts,language="english",width=None,unk=None):
+        '''
+        Tokenizes raw text with TOKEN_RE and the vocab index.
+        Unknown words map to unk (default <end>), rows are padded with <end>
+        :type texts: str or list of str
+        Returns ((B,W) long tensor, (B,) lengths)
+        '''
+        vocab = getattr(self,f"{language}_vocab")
+        pad = getattr(self,f"{language}_eos")
+        unk = pad if unk is None else unk
+        if isinstance(texts,str):
+            texts = [texts]
+        rows = [[vocab.get(w,unk) for w in TOKEN_RE.split(t)] for t in texts]
+        lengths = torch.tensor([len(r) for r in rows],dtype=torch.long)
+        W = int(lengths.max()) if width is None else width
+        x = torch.full((len(rows),W),pad,dtype=torch.long)
+        for b,r in enumerate(rows):
+            r = r[:W]
+            x[b,:len(r)] = torch.tensor(r,dtype=torch.long)
+        return x.to(self.device),lengths.clamp(max=W).to(self.device)
+
+    def token_index(self,language="english"):
+        '''
+        Cached TokenIndex of a language, ids count train sentences first
+        '''
+        tables = self.__dict__.setdefault("_token_index",{})
+        if language not in tables:
+            tables[language] = TokenIndex(os.path.join(DIR,LANG_FILES[language]))
+        return tables[language]
+
+    def sentences_by_id(self,ids,language="english"):
+        '''
+        Sentences of TokenIndex ids (train first, then test), as a long
+        tensor of shape (N,L), train rows first, padded with 1
+        '''
+        tr,te = self.token_index(language).split(ids)
+        xs = []
+        for split,idx in (("train",tr),("test",te)):
+            idx = torch.as_tensor(idx,dtype=torch.long,device=self.device)
+            if self.var_len:
+                x,_ = gather_ragged(getattr(self,f"{language}_tokens_{split}"),getattr(self,f"{language}_offsets_{split}"),idx)
+            else:
+                x = getattr(self,f"{language}_sentences_{split}")[idx].long()
+            xs.append(x)
+        W = max(x.size(1) for x in xs)
+        return torch.cat([F.pad(x,(0,W-x.size(1)),value=1) for x in xs],dim=0)
+
+    def containing(self,*words,language="english",n=None):
+        '''
+        (ids, sentences) of the first n sentences containing every one of
+        words, looked up in the token index instead of scanning the corpus
+        '''
+        vocab = getattr(self,f"{language}_vocab")
+        ids = self.token_index(language).sentences_with(*[vocab[w] for w in words])[:n]
+        return ids,self.sentences_by_id(ids,language)
+
+    def lengths(self,lang="english"):
+        return getattr(self,f"{lang}_lengths_{self.mode}")
+
+    def get_ragged(self,lang,idx):
+        tokens  = getattr(self,f"{lang}_tokens_{self.mode}")
+        offsets = getattr(self,f"{lang}_offsets_{self.mode}")
+        if torch.is_tensor(idx) and idx.dim()==1:
+            return gather_ragged(tokens,offsets,idx)
+        x,lengths = gather_ragged(tokens,offsets,torch.as_tensor([idx],device=offsets.device))
+        return x[0],lengths[0]
+
+    ### mode lives in a one-element tensor so that, once shared,
+    ### persistent DataLoader workers follow test()/train() in the parent
+    @property
+    def mode(self):
+        return ("train","test")[int(self._mode[0])]
+    @mode.setter
+    def mode(self,v):
+        if "_mode" not in self.__dict__:
+            self._mode = torch.zeros(1,dtype=torch.long)
+        self._mode[0] = ("train","test").index(v)
+
+    def share_memory(self):
+        '''
+        Moves every CPU tensor attribute into shared memory, so forked or
+        spawned DataLoader workers read the same pages instead of copies
+        '''
+        self.shared = True
+        for k,v in list(self.__dict__.items()):
+            if torch.is_tensor(v) and v.device.type=='cpu' and not v.is_shared():
+                try:
+                    v.share_memory_()
+                except RuntimeError:
+                    ### np.load(mmap_mode=...) storage is file-backed already
+                    pass
+        return self
+
+    def _set_shared(self,name,v):
+        ### in-place update of a shared buffer, so running workers see it
+        old = self.__dict__.get(name)
+        if getattr(self,"shared",False) and old is not None and old.shape==v.shape and old.is_shared():
+            old.copy_(v)
+            return
+        if getattr(self,"shared",False) and v.device.type=='cpu':
+            v.share_memory_()
+        setattr(self,name,v)
 
     def test(self):
         self.mode = "test"
     def train(self):
         self.mode = "train"
     def __getitem__(self, idx):
+        ### numpy and 0-d tensor indices are single items too
+        if isinstance(idx,numbers.Integral) or getattr(idx,"ndim",None)==0:
+            return self._get(int(idx))
+        return self._get_batch(idx)
+
+    def _get_batch(self, idx):
+        '''
+        Batch access: takes a list or (B,) tensor of indices and returns
+        pre-stacked (B,L) tensors with one gather per field.
+        Not named __getitems__, which DataLoader would call and then
+        hand to collate_fn as if it were a list of samples.
+        '''
+        if not torch.is_tensor(idx):
+            idx = list(idx)
+        idx = torch.as_tensor(idx,dtype=torch.long).to(self.device)
+        return self._get(idx)
+
+    def _get(self, idx):
         # torch.set_default_tensor_type(torch.FloatTensor)
-        if(self.mode=="test"):
-            german_item = self.german_sentences_test[idx]
-            english_item = self.english_sentences_test[idx]
-        else:
-            german_item = self.german_sentences_train[idx]
-            english_item = self.english_sentences_train[idx]
+        item = {"index":idx}
+        for lang in self.languages:
+            if self.var_len:
+                item[lang],item[lang+"_length"] = self.get_ragged(lang,idx)
+            else:
+                ### long in both modes, mmap storage is int16/int32
+                item[lang] = getattr(self,f"{lang}_sentences_{self.mode}")[idx].long()
         #
         # Tooo slow
         # # gl = german_logits*logit_mask
         # if self.mode=='test':
         #     idx = idx + len(self.german_sentences_train)
+        ### id over both splits, train rows first as in token_index()
+        n_train = len(getattr(self,f"{self.languages[0]}_lengths_train"))
+        item["sentence_id"] = idx if self.mode=="train" else idx+n_train
+        return item
 
-        return {
-        "index":idx,
-        "german":german_item,
-                # "english":english_item.to(self.device)[::2],
-                "english":english_item,
-                # "logits":german_logits.to(self.device),
-                # "logit_mask":logit_mask.to(self.device)
-                }
     def __len__(self):
-        if(self.mode=="test"):
-            return len(self.german_sentences_test)
-        else:
-            return len(self.german_sentences_train)
+        return len(getattr(self,f"{self.languages[0]}_lengths_{self.mode}"))
     def total_length(self):
-        return  len(self.german_sentences_test)+len(self.german_sentences_train)
+        lang = self.languages[0]
+        return  len(getattr(self,f"{lang}_lengths_test"))+len(getattr(self,f"{lang}_lengths_train"))
+
+def sample_mask_index(shape,n_mask,generator=None,lengths=None):
+    '''
+    Draws n_mask distinct positions along the last axis for every row,
+    as the top-k of a uniform random matrix.
+    With `lengths`, positions stay below the length of each row. Rows
+    shorter than n_mask have every position drawn, some of them twice.
+    Returns a long tensor of shape shape[:-1]+(n_mask,)
+    '''
+    r = torch.rand(shape,generator=generator)
+    if lengths is None:
+        return r.topk(n_mask,dim=-1)[1]
+    lengths = lengths.cpu()[...,None]
+    r = r - (torch.arange(shape[-1]) >= lengths).float()
+    return r.topk(n_mask,dim=-1)[1] % lengths.clamp(min=1)
+
+def extract_and_mask(x,idx,mask_token_idx):
+    '''
+    :type x:   shape of (..., L)
+    :type idx: shape of (..., n_mask)
+    Returns (extracted, masked)
+    '''
+    y = torch.gather(x,index=idx,dim=-1)
+    z = x.scatter(-1,idx,mask_token_idx)
+    return y,z
+
+def build_token_index(fn):
+    '''
+    Builds {prefix}.index.npz for a pickled corpus, over all sentences
+    with train rows first, i.e. sentence id = i (train) or n_train+i (test)
+        indptr  (V+1,) int64   CSR row pointers, one row per token
+        indices (nnz,) int32   sorted ids of sentences containing the token
+        freq    (V,)   int64   total occurrences of each token
+        hashes  (N,)   uint64  blake2b digest of each sentence's ids
+    '''
+    load = torch.load(fn)
+    xx = load['train_data'] + load['test_data']
+    V,N = load['vocab_len'],len(xx)
+    tok = torch.cat(xx,dim=0).numpy().astype(np.int64)
+    sid = np.repeat(np.arange(N,dtype=np.int64),[len(x) for x in xx])
+    ### one entry per (token, sentence) pair, grouped by token then sentence
+    key = np.unique(tok*N + sid)
+    indptr = np.zeros(V+1,dtype=np.int64)
+    np.cumsum(np.bincount(key//N,minlength=V),out=indptr[1:])
+    hashes = np.array([int.from_bytes(hashlib.blake2b(x.numpy().astype(np.int32).tobytes(),digest_size=8).digest(),'little') for x in xx],dtype=np.uint64)
+    out_fn = f'{memmap_prefix(fn)}.index.npz'
+    np.savez(out_fn,indptr=indptr,indices=(key%N).astype(np.int32),
+        freq=np.bincount(tok,minlength=V),hashes=hashes,n_train=len(load['train_data']))
+    return out_fn
+
+class TokenIndex(object):
+    '''
+    Inverted index over a corpus, see build_token_index().
+    Loaded from the cached .npz, rebuilt when missing or older than the pickle.
+    '''
+    def __init__(self,fn,rebuild=False):
+        out_fn = f'{memmap_prefix(fn)}.index.npz'
+        if rebuild or not os.path.exists(out_fn) or os.path.getmtime(out_fn) < os.path.getmtime(fn):
+            build_token_index(fn)
+        load = np.load(out_fn)
+        self.indptr  = load['indptr']
+        self.indices = load['indices']
+        self.freq    = load['freq']
+        self.hashes  = load['hashes']
+        self.n_train = int(load['n_train'])
+
+    def doc_freq(self):
+        return np.diff(self.indptr)
+
+    def sentences_with(self,*tokens):
+        '''
+        Ids of sentences containing every one of tokens, in O(hits)
+        '''
+        ids = None
+        for t in sorted(tokens,key=lambda t:self.indptr[t+1]-self.indptr[t]):
+            hit = self.indices[self.indptr[t]:self.indptr[t+1]]
+            ids = hit if ids is None else np.intersect1d(ids,hit,assume_unique=True)
+        return ids
+
+    def duplicates(self):
+        '''
+        Groups of ids of sentences with identical token ids
+        '''
+        order = np.argsort(self.hashes,kind='stable')
+        h = self.hashes[order]
+        cuts = np.flatnonzero(h[1:]!=h[:-1])+1
+        return [g for g in np.split(order,cuts) if len(g)>1]
+
+    def split(self,ids):
+        '''
+        Global ids -> (train ids, test ids) as used by dataset.train()/test()
+        '''
+        ids = np.asarray(ids)
+        return ids[ids<self.n_train],ids[ids>=self.n_train]-self.n_train
+
+def mask_schedule_path(fn,n_mask,width,seed):
+    return f'{memmap_prefix(fn)}.mask{n_mask}.w{width}.seed{seed}.npy'
+
+def write_mask_schedule(fn,n_epoch,n_mask=4,width=15,seed=0,var_len=False):
+    '''
+    Precomputes n_epoch epochs of mask positions for every sentence of
+    a pickled corpus, train rows first then test rows, into
+        {prefix}.mask{n_mask}.w{width}.seed{seed}.npy  (n_epoch,N,n_mask) uint8
+    Positions range over the first `width` tokens, or over each sentence's
+    own length if var_len. Epochs are drawn one at a time from a seeded
+    generator, so the file does not depend on n_epoch.
+    '''
+    load = torch.load(fn)
+    xx = load['train_data'] + load['test_data']
+    if var_len:
+        width   = max(len(x) for x in xx)
+        lengths = torch.tensor([len(x) for x in xx])
+    else:
+        lengths = None
+    assert width <= 256,'positions must fit uint8'
+    g = torch.Generator()
+    g.manual_seed(seed)
+    out_fn = mask_schedule_path(fn,n_mask,'var' if var_len else width,seed)
+    out = np.lib.format.open_memmap(out_fn,mode='w+',dtype=np.uint8,shape=(n_epoch,len(xx),n_mask))
+    for e in range(n_epoch):
+        out[e] = sample_mask_index((len(xx),width),n_mask,g,lengths).numpy()
+    out.flush()
+    return out_fn
+
+class BucketBatchSampler(torch.utils.data.Sampler):
+    '''
+    Yields batches of indices of similar length under the current
+    mode of the dataset. Sentences are sorted by length with a random
+    tie-break, cut into batches, and the batch order is shuffled.
+    '''
+    def __init__(self,dataset,batch_size,shuffle=True,lang="english",generator=None):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.lang = lang
+        self.generator = generator
+
+    def __iter__(self):
+        lengths = self.dataset.lengths(self.lang).cpu().double()
+        if self.shuffle:
+            lengths = lengths + torch.rand(lengths.shape,generator=self.generator)
+        batches = lengths.argsort().split(self.batch_size)
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches),generator=self.generator)]
+        for b in batches:
+            yield b.tolist()
+
+    def __len__(self):
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+def seed_worker(worker_id):
+    ### forked workers would otherwise share one mask generator state
+    info = torch.utils.data.get_worker_info()
+    if getattr(info.dataset,"generator",None) is not None:
+        info.dataset.generator.manual_seed(info.seed)
+
+def batch_dataloader(dataset,batch_size,shuffle=False,bucket=False,num_workers=0,**kw):
+    '''
+    DataLoader driven by a BatchSampler, so that each batch is fetched
+    through dataset[indices] (_get_batch) in one call instead of collating
+    batch_size per-item dicts
+
+    :param bucket: group sentences of similar length with BucketBatchSampler
+    :param num_workers: prepare batches in worker processes. The corpus
+        is moved to shared memory first and workers are kept alive across
+        epochs, so it is never copied per worker.
+    '''
+    if num_workers:
+        assert dataset.device.type=='cpu','workers need a CPU dataset'
+        dataset.share_memory()
+        kw = dict(dict(num_workers=num_workers,persistent_workers=True,worker_init_fn=seed_worker),**kw)
+    if bucket:
+        sampler = BucketBatchSampler(dataset,batch_size,shuffle=shuffle)
+        return torch.utils.data.DataLoader(dataset,sampler=sampler,batch_size=None,**kw)
+    if shuffle:
+        sampler = torch.utils.data.RandomSampler(dataset)
+    else:
+        sampler = torch.utils.data.SequentialSampler(dataset)
+    sampler = torch.utils.data.BatchSampler(sampler,batch_size,drop_last=False)
+    return torch.utils.data.DataLoader(dataset,sampler=sampler,batch_size=None,**kw)
+
+class ShardedSentenceStream(torch.utils.data.IterableDataset):
+    '''
+    Streams ready-made batches from the shards written by write_shards(),
+    so that memory stays bounded by shuffle_buffer no matter the corpus size.
+
+    Shards are split across DataLoader workers, visited in a shuffled order,
+    and sentences pass through a bounded shuffle buffer. With n_mask set,
+    each batch is masked in the stream and carries "extracted"/"masked"
+    like RefillDataset, with '<mask>' appended to the vocabulary.
+
+    Use with DataLoader(stream,batch_size=None,num_workers=...)
+    '''
+    def __init__(self,fn=source_lang_file,split="train",batch_size=60,min_len=15,
+        shuffle_buffer=10000,n_mask=None,var_len=False,seed=None):
+        super().__init__()
+        self.prefix = memmap_prefix(os.path.join(DIR,fn))
+        with open(f'{self.prefix}.vocab.json','r') as f:
+            meta = json.load(f)
+        self.vocab          = meta['vocab']
+        self.vocab_reversed = meta['vocab_reversed']
+        self.vocab_len      = meta['vocab_len']
+        self.pad            = meta['pad']
+        self.shard_size     = meta['shard_size']
+        self.shards = sorted(glob.glob(f'{self.prefix}.{split}.shard*.offsets.npy'))
+        assert len(self.shards),f'No shards for {self.prefix}.{split}, run write_shards() first'
+        self.split          = split
+        self.batch_size     = batch_size
+        self.min_len        = min_len
+        self.shuffle_buffer = shuffle_buffer
+        self.var_len        = var_len
+        self.n_mask         = n_mask
+        self.seed           = random.randrange(2**31) if seed is None else seed
+        self.epoch          = 0
+        if n_mask is not None:
+            self.vocab['<mask>'] = len(self.vocab_reversed)
+            self.vocab_reversed.append('<mask>')
+            self.vocab_len += 1
+
+    def set_epoch(self,epoch):
+        self.epoch = epoch
+
+    def _sentences(self,shards,g):
+        for k in torch.randperm(len(shards),generator=g).tolist():
+            fn = shards[k]
+            offsets = np.load(fn)
+            tokens  = np.load(fn.replace('.offsets.npy','.tokens.npy'),mmap_mode='r')
+            base    = self.shard_size * int(fn.rsplit('.shard',1)[1].split('.')[0])
+            for i in range(len(offsets)-1):
+                x = torch.from_numpy(tokens[offsets[i]:offsets[i+1]].astype(np.int64))
+                yield base+i,x
+
+    def _batch(self,rows,g):
+        index = [r[0] for r in rows]
+        rows  = [r[1] for r in rows]
+        lengths = torch.tensor([len(r) for r in rows])
+        x = torch.nn.utils.rnn.pad_sequence(rows,batch_first=True,padding_value=self.pad)
+        if not self.var_len:
+            lengths = lengths.clamp(max=self.min_len)
+            x = F.pad(x[:,:self.min_len],(0,max(0,self.min_len-x.size(1))),value=self.pad)
+        item = {
+            "index":torch.tensor(index),
+            "english":x,
+            "english_length":lengths,
+            }
+        if self.n_mask is not None:
+            idx = sample_mask_index(x.shape,self.n_mask,g,lengths)
+            item["extracted"],item["masked"] = extract_and_mask(x,idx,self.vocab['<mask>'])
+        return item
+
+    def __iter__(self):
+        info = torch.utils.data.get_worker_info()
+        wid,nw = (0,1) if info is None else (info.id,info.num_workers)
+        g = torch.Generator()
+        g.manual_seed(self.seed + 1000003*self.epoch + wid)
+        buf = []
+        rows = []
+        for item in self._sentences(self.shards[wid::nw],g):
+            if len(buf) < self.shuffle_buffer:
+                buf.append(item)
+                continue
+            j = int(torch.randint(len(buf),(1,),generator=g))
+            buf[j],item = item,buf[j]
+            rows.append(item)
+            if len(rows)==self.batch_size:
+                yield self._batch(rows,g)
+                rows = []
+        for j in torch.randperm(len(buf),generator=g).tolist():
+            rows.append(buf[j])
+            if len(rows)==self.batch_size:
+                yield self._batch(rows,g)
+                rows = []
+        if len(rows):
+            yield self._batch(rows,g)
 
 import random
 class RefillDataset(EnglishToGermanDataset):
-    def __init__(self,CUDA=False):
-        super().__init__(CUDA)
+    def __init__(self,CUDA=False,mmap=False,seed=None,online_mask=False,var_len=False,mask_schedule=None,languages=("english",)):
+        '''
+        :param seed: seeds the torch.Generator that draws mask positions.
+            Test masks always come from test_mask_seed instead, so that
+            the test loss is reproducible across runs and fetches.
+        :param online_mask: draw masks per fetched batch instead of
+            materialising english_extracted_*/english_masked_* for the corpus.
+            Always on with var_len.
+        :param mask_schedule: path of a write_mask_schedule() file. Mask
+            positions are then read from its row for the current epoch
+            instead of being drawn.
+        '''
+        super().__init__(CUDA,mmap,var_len,languages)
         self.english_vocab_len += 1
         idx = len(self.english_vocab_reversed)
         self.english_vocab_reversed.append('<mask>')
         self.english_vocab['<mask>'] =idx
-        self.op_extract_and_mask(2)
+        self.generator = torch.Generator()
+        if seed is not None:
+            self.generator.manual_seed(seed)
+        else:
+            self.generator.seed()
+        self.online_mask = online_mask or var_len
+        self.mask_schedule = None if mask_schedule is None else np.load(mask_schedule,mmap_mode='r')
+        if self.mask_schedule is not None:
+            self.check_mask_schedule(mask_schedule)
+        ### (epoch, n_mask), a tensor for the same reason as EnglishToGermanDataset.mode
+        self._mask_state = torch.zeros(2,dtype=torch.long)
+        if self.mask_schedule is not None:
+            self.op_extract_and_mask(self.mask_schedule.shape[-1])
+        else:
+            self.op_extract_and_mask(2)
+
+    @property
+    def epoch(self):
+        return int(self._mask_state[0])
+    @epoch.setter
+    def epoch(self,v):
+        self._mask_state[0] = v
+    @property
+    def n_mask(self):
+        return int(self._mask_state[1])
+    @n_mask.setter
+    def n_mask(self,v):
+        self._mask_state[1] = v
 
-    def op_extract_and_mask(self,n_mask):
+    def op_extract_and_mask(self,n_mask,epoch=None):
         #### randomly take out tokens and put mask at its position
-        train_idx = range(0,len(self.english_sentences_train))
-        test_idx =range(len(self.english_sentences_train), len(self.english_sentences_train)+len(self.english_sentences_test))
-        x = torch.cat([self.english_sentences_train,self.english_sentences_test],dim=0)
-        idx = [random.sample(range(x.size(1)), n_mask) for _ in range(x.size(0))]
-        idx = torch.tensor(idx).to(self.device)
-        y = torch.gather(x,index=idx,dim=1)
-        z = x.clone()
-        z = torch.scatter(z,index=idx,dim=1,src=torch.tensor(self.english_vocab['<mask>']).to(self.device)[None,None].repeat(idx.shape))
-        # import pdb; pdb.set_trace()
-        self.english_extracted_train = y[train_idx]
-        self.english_masked_train = z[train_idx]
-        self.english_extracted_test = y[test_idx]
-        self.english_masked_test = z[test_idx]
+        self.n_mask = n_mask
+        if epoch is not None:
+            self.epoch = epoch
+        if self.mask_schedule is not None:
+            assert self.mask_schedule.shape[-1]==n_mask,(self.mask_schedule.shape,n_mask)
+        if self.online_mask:
+            ### train masks deferred to __getitem__, test masks frozen here
+            if self.mask_schedule is None:
+                self._set_shared("english_mask_index_test",self.test_mask_index(n_mask).to(self.device))
+            return
+        Ntrain = len(self.english_sentences_train)
+        x = torch.cat([self.english_sentences_train,self.english_sentences_test],dim=0).long()
+        if self.mask_schedule is not None:
+            idx = self.scheduled_mask_index(slice(None)).to(self.device)
+        else:
+            idx = sample_mask_index(x.shape,n_mask,self.generator)
+            idx[Ntrain:] = self.test_mask_index(n_mask)
+            idx = idx.to(self.device)
+        y,z = extract_and_mask(x,idx,self.english_vocab['<mask>'])
+        self._set_shared("english_extracted_train",y[:Ntrain].contiguous())
+        self._set_shared("english_masked_train",z[:Ntrain].contiguous())
+        self._set_shared("english_extracted_test",y[Ntrain:].contiguous())
+        self._set_shared("english_masked_test",z[Ntrain:].contiguous())
 
-    def __getitem__(self, idx):
+    ### seed of the test masks, fixed so that test losses are comparable
+    test_mask_seed = 0
+    def test_mask_index(self,n_mask):
+        '''
+        Mask positions of the whole test split, shape of (N_test,n_mask),
+        drawn from test_mask_seed whatever the seed of the train masks
+        '''
+        g = torch.Generator()
+        g.manual_seed(self.test_mask_seed)
+        lengths = self.english_lengths_test.cpu()
+        if self.var_len:
+            return sample_mask_index((len(lengths),int(lengths.max())),n_mask,g,lengths)
+        return sample_mask_index((len(lengths),self.min_len),n_mask,g)
+
+    def check_mask_schedule(self,fn):
+        '''
+        Asserts that a write_mask_schedule() file was written for this
+        corpus and sequence width, so that a stale file cannot mask the
+        wrong positions
+        '''
+        n_epoch,N,n_mask = self.mask_schedule.shape
+        n_total = self.total_length()
+        assert N==n_total,f'{fn}: schedule has {N} sentences, the corpus {n_total}'
+        m = re.search(r'\.w(\d+|var)\.',os.path.basename(fn))
+        if m is not None:
+            width = 'var' if self.var_len else str(self.min_len)
+            assert m.group(1)==width,f'{fn}: written for width {m.group(1)}, the dataset uses {width}'
+        ### positions of the first epoch must fall inside each sentence
+        if self.var_len:
+            limit = torch.cat([self.english_lengths_train,self.english_lengths_test]).cpu().numpy()
+        else:
+            limit = self.min_len
+        bad = int((np.asarray(self.mask_schedule[0]).max(-1) >= limit).sum())
+        assert bad==0,f'{fn}: {bad} sentences masked beyond their width'
+
+    def scheduled_mask_index(self,idx):
+        '''
+        Rows of the mask schedule for the current epoch, cycling if
+        training outlasts the file. idx indexes the current split.
+        '''
+        rows = self.mask_schedule[self.epoch % len(self.mask_schedule)]
+        if not isinstance(idx,slice):
+            idx = torch.as_tensor(idx).cpu().numpy()
+            if self.mode=="test":
+                idx = idx + len(self.english_lengths_train)
+        return torch.from_numpy(np.asarray(rows[idx],dtype=np.int64))
+
+    def mask(self,x,lengths=None,index=None):
+        '''
+        Masks a fetched (..., L) slice on the fly
+        '''
+        x = x.long()
+        if self.mask_schedule is not None:
+            idx = self.scheduled_mask_index(index).to(x.device)
+        elif self.mode=="test":
+            idx = self.english_mask_index_test[index].to(x.device)
+        else:
+            idx = sample_mask_index(x.shape,self.n_mask,self.generator,lengths).to(x.device)
+        return extract_and_mask(x,idx,self.english_vocab['<mask>'])
+
+    def _get(self, idx):
         # torch.set_default_tensor_type(torch.FloatTensor)
         # print(idx)
-        if(self.mode=="test"):
-            german_item = self.german_sentences_test[idx]
-            x = english_item = self.english_sentences_test[idx]
+        item = super()._get(idx)
+        if self.online_mask:
+            extracted,masked = self.mask(item["english"],item.get("english_length"),idx)
+        elif(self.mode=="test"):
             extracted = self.english_extracted_test[idx]
             masked    = self.english_masked_test[idx]
         else:
-            german_item = self.german_sentences_train[idx]
-            x = english_item = self.english_sentences_train[idx]
             extracted = self.english_extracted_train[idx]
             masked     = self.english_masked_train[idx]
-        #
-        # Tooo slow
-        # # gl = german_logits*logit_mask
-        # if self.mode=='test':
-        #     idx = idx + len(self.german_sentences_train)
+        item["extracted"] = extracted
+        item["masked"] = masked
+        return item
+
 
-        return {
-                "index":idx,
-                "extracted":extracted,
-                "masked":masked,
-                "english":x,
-                "german":german_item,
-                }
-                    # def __getitem__()
+if __name__ == '__main__':
+    import sys
+    ### one-time conversion for EnglishToGermanDataset(mmap=True)
+    for fn in [source_lang_file,dest_lang_file]:
+        print(f"CONVERTING {fn}")
+        convert_to_memmap(os.path.join(DIR,fn))
+        if '--shard_size' in sys.argv:
+            ### and for ShardedSentenceStream
+            write_shards(os.path.join(DIR,fn),int(sys.argv[sys.argv.index('--shard_size')+1]))
+    if '--index' in sys.argv:
+        for fn in [source_lang_file,dest_lang_file]:
+            print(build_token_index(os.path.join(DIR,fn)))
+    if '--mask_epochs' in sys.argv:
+        ### masks for RefillDataset(mask_schedule=...), english only
+        print(write_mask_schedule(os.path.join(DIR,source_lang_file),int(sys.argv[sys.argv.index('--mask_epochs')+1])))
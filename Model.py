@@ -3,6 +3,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim
+from markov_lm.util_sample import sample_categorical, reinforce_objective, RunningBaseline
 # from model_mrf import *
 
 class RNNWithSampling(nn.Module):
@@ -20,6 +21,12 @@ class RNNWithSampling(nn.Module):
         self.n_step      = min_len
         self.state_pref  = nn.Linear   ( embed_dim*2,  state_count).to(self.device)
         self.state_move  = nn.Embedding( state_count, embed_dim).to(self.device)
+        self.reward_baseline = RunningBaseline(total_length).to(self.device)
+
+    ### chains sampled per sequence, and the REINFORCE estimator of
+    ### log_prob_grad, see util_sample.reinforce_objective
+    n_sample  = 10
+    reinforce = 'none'
 
     def sample_tokens(self,z,n_step,n_sample):
         zs,lp   = self.sample_trajectory(z,n_step,n_sample)
@@ -35,14 +42,10 @@ class RNNWithSampling(nn.Module):
         for i in range(n_step):
             z    = z / (0.00001 + z.std(-1,keepdims=True)) *0.113
 
-            rd   = torch.rand(z.shape[:2]).to(self.device)
-            # torch.rand(list(z.shape)+n_sample)
-            # import pdb; pdb.set_trace()
             pref = self.state_pref(torch.cat([zold,z],dim=-1))
             xp   = pref.softmax(dim=-1)
-            xpc  = xp.cumsum(-1)
             # import pdb; pdb.set_trace()
-            val,which = (rd[:,:,None]<xpc).max(dim=-1)
+            which = sample_categorical(pref)
             xps  = torch.gather(xp,dim=-1,index=which[:,:,None])[:,:,0]
             lp   = lp + torch.log(xps)
 
@@ -56,7 +59,7 @@ class RNNWithSampling(nn.Module):
 
 
     def log_prob(self,zi,y):
-        n_sample = 10
+        n_sample = self.n_sample
         z = self.latent[zi]
         ys,lp = self.sample_tokens(z,self.n_step,n_sample)
 
@@ -65,15 +68,17 @@ class RNNWithSampling(nn.Module):
         yp    = torch.gather(ys,index=y[:,:,None,None].repeat((1,1,n_sample,1)),dim=-1)[:,:,:,0]
         return yp.mean(2)
 
-    def log_prob_grad(self,zi,y):
-        n_sample = 10
+    def log_prob_grad(self,zi,y,ids=None):
+        n_sample = self.n_sample
         z = self.latent[zi]
         ys,lp = self.sample_tokens(z,self.n_step,n_sample)
 
         ### Apply REINFORCE loss, that is weighting the loss by log(p)
         # import pdb; pdb.set_trace()
         yp    = torch.gather(ys,index=y[:,:,None,None].repeat((1,1,n_sample,1)),dim=-1)[:,:,:,0]
-        gradloss = yp * lp[:,None,:]
+        ### ids: item['sentence_id'], zi restarts from 0 on the test split
+        b = self.reward_baseline(zi if ids is None else ids,yp) if self.reinforce=='ema' else None
+        gradloss = reinforce_objective(yp,lp[:,None,:],self.reinforce,b)
         gradloss = gradloss.mean(-1)
         # gradloss = (yp * lp.softmax(-1)[:,None,:]).sum(-1)
 
@@ -126,11 +131,29 @@ class RNNWithSigmoid(nn.Module):
     log_prob_grad = log_prob
 
 
+def markov_powers(att,xtran,n_step):
+    '''
+    att, att.T, att.T^2, ..., att.T^(n_step-1) by doubling: each round
+    multiplies all rows so far by T^m and squares T^m, so only
+    O(log n_step) sequential batched matmuls are needed.
+    :type att:   shape of (B,1,S)
+    :type xtran: shape of (B,S,S)
+    Returns shape of (B,n_step,S)
+    '''
+    atts,xp = att,xtran
+    while atts.size(1) < n_step:
+        atts = torch.cat([atts,atts.matmul(xp)],dim=1)
+        if atts.size(1) < n_step:
+            xp = xp.matmul(xp)
+    return atts[:,:n_step]
+
 class RNNWithMarkovNet(nn.Module):
     '''
     Use a markov transfer function to model RNN transfer.
     Model sentence as a transfer of attention
     '''
+    ### set False for the step-by-step att.matmul(xtran) loop
+    parallel_trajectory = True
     def __init__(self, device, graph_dim,embed_dim,mixture_count,state_count,total_length,min_len):
         super().__init__()
         # state_count = 5
@@ -160,6 +183,9 @@ class RNNWithMarkovNet(nn.Module):
         # xtran = xq.transpose(2,1).matmul(xk).softmax(1)
         xtran = (xq.matmul(xk.transpose(2,1))/self.embed_dim**0.5).softmax(1)
         att = xi[:,:,:1].softmax(1).transpose(2,1)
+        if self.parallel_trajectory:
+            ### every emission in one batched matmul
+            return markov_powers(att,xtran,n_step).matmul(xv)
         zs = torch.tensor([],requires_grad=True).to(self.device)
         for i in range(n_step):
             emit = att.matmul(xv)
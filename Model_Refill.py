@@ -2,11 +2,370 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim
+from torch.utils.checkpoint import checkpoint
+import copy
+import warnings
+from markov_lm.util_sample import sample_categorical, reinforce_objective, RunningBaseline
+from markov_lm.Model import markov_powers
 
 
 
 
 
+class StepOutputs(list):
+    '''
+    Per-position outputs of _step, each of shape (B,1,...) along `dim`,
+    concatenated once by _run_steps instead of torch.cat on every step.
+    Tensor-style indexing (as callbacks do) materialises the full tensor.
+    '''
+    def __init__(self,dim=1):
+        super().__init__()
+        self.dim = dim
+    def tensor(self):
+        return torch.cat(list(self),dim=self.dim)
+    def __getitem__(self,idx):
+        if isinstance(idx,(int,slice)):
+            return list.__getitem__(self,idx)
+        return self.tensor()[idx]
+
+class SweepSlots(object):
+    '''
+    Per-position state of a sweep, kept as a list of (B,1,...) slots along
+    dim 1. put() replaces one slot without copying the others, so autograd
+    only retains the slot written at each step instead of a full copy of
+    the tensor. Reading a single position ([:,i:i+1]) returns its slot, any
+    other read materialises the full tensor once and caches it until the
+    next put(). len(), shape, device and dtype come from the slots; other
+    tensor methods need an explicit tensor().
+    '''
+    def __init__(self,x):
+        self.slots = list(x.split(1,dim=1))
+        self.full  = x
+    def put(self,i,v):
+        self.slots[i] = v
+        self.full = None
+        return self
+    def tensor(self):
+        if self.full is None:
+            self.full = torch.cat(self.slots,dim=1)
+        return self.full
+    def __len__(self):
+        return len(self.slots[0])
+    @property
+    def shape(self):
+        s = self.slots[0].shape
+        return s[:1]+(sum(v.size(1) for v in self.slots),)+s[2:]
+    @property
+    def device(self):
+        return self.slots[0].device
+    @property
+    def dtype(self):
+        return self.slots[0].dtype
+    def __getitem__(self,idx):
+        if isinstance(idx,tuple) and len(idx)==2 and idx[0]==slice(None) and isinstance(idx[1],slice):
+            a,b = idx[1].start,idx[1].stop
+            if idx[1].step is None and a is not None and b==a+1 and 0<=a<len(self.slots):
+                return self.slots[a]
+        return self.tensor()[idx]
+
+class BatchContext(object):
+    '''
+    Loop-invariant quantities of one batch, which depend only on the
+    candidate set y (B,M,E) and on parameters. Each is computed on first
+    use and then shared by every step and sweep. With cache=False they are
+    recomputed on every call, as the steps used to do.
+
+    With lengths (B,) the rows are padded past their true length, and
+    right() hides the padding from the positions next to it.
+    '''
+    def __init__(self,model,y,z=None,cache=True,lengths=None):
+        self.model = model
+        self.y     = y
+        self.z     = z
+        self.cache = cache
+        self.lengths = None if lengths is None else lengths.to(y.device)
+        self.values = {}
+    def _get(self,name,f):
+        if not self.cache:
+            return f()
+        if name not in self.values:
+            self.values[name] = f()
+        return self.values[name]
+
+    def right(self,i,xr):
+        '''
+        xr read as the right neighbour of position i, zero in the rows
+        that end at i, as if i were the last position of the row.
+        i is an int or positions of shape (P,), xr of shape (B,1 or P,...)
+        '''
+        if self.lengths is None:
+            return xr
+        valid = torch.as_tensor(i,device=xr.device)+1 < self.lengths[:,None]
+        return xr.masked_fill(~valid.reshape(valid.shape+(1,)*(xr.dim()-2)),0.)
+    def pad_logits(self,att):
+        '''
+        att (B,n,L) over the L positions, -inf past the true length
+        '''
+        if self.lengths is None:
+            return att
+        valid = torch.arange(att.size(-1),device=att.device) < self.lengths[:,None]
+        return att.masked_fill(~valid[:,None],float('-inf'))
+
+    def xkey_static(self,n=2):
+        '''
+        :return: shape of (B,n,E)
+        '''
+        m = self.model
+        return self._get(('xkey_static',n),lambda: m.xkey_static.weight[None,:n,:m.embed_dim].repeat((len(self.y),1,1)))
+    def xkey_dynamic(self):
+        return self._get('xkey_dynamic',lambda: self.model.xkey_dynamic(self.y))
+    def xkey(self,n=2):
+        '''
+        Keys of the [static..., y] candidates, shape of (B,n+M,E)
+        '''
+        return self._get(('xkey',n),lambda: torch.cat([self.xkey_static(n), self.xkey_dynamic()],dim=1))
+    def selector_k(self):
+        return self._get('selector_k',lambda: self.model.selector_k(self.y))
+    def cand(self):
+        '''
+        selector_q attention over y, shape of (B,mixture_count,E)
+        '''
+        m = self.model
+        return self._get('cand',lambda: m.selector_q.weight[None].matmul(self.selector_k().transpose(2,1)).softmax(-1).matmul(self.y))
+
+    def lp_z(self):
+        '''
+        vocab log-probs of every input position, shape of (B,L,V)
+        '''
+        return self._get('lp_z',lambda: self.model.vocab(self.z).log_softmax(-1))
+    def lp_y(self):
+        '''
+        vocab log-probs of the candidates, shape of (B,M,V)
+        '''
+        return self._get('lp_y',lambda: self.model.vocab(self.y).log_softmax(-1))
+    def cand_logp(self,i,xs=None):
+        '''
+        vocab log-probs of the candidates [z_i, xs, y], shape of (B,1+n+M,V).
+        With model.cache_vocab_logp only xs (B,n,E) is projected per call,
+        the z_i and y rows are sliced from lp_z() and lp_y().
+        '''
+        m  = self.model
+        xs = [] if xs is None else [xs]
+        if not (self.cache and m.cache_vocab_logp):
+            return m.vocab(torch.cat([self.z[:,i:i+1]]+xs+[self.y],dim=1)).log_softmax(-1)
+        return torch.cat([self.lp_z()[:,i:i+1]]+[m.vocab(x).log_softmax(-1) for x in xs]+[self.lp_y()],dim=1)
+    def cand_logp_at(self,idx,xs=None):
+        '''
+        cand_logp() of the positions idx (P,) at once, xs of shape (B,P,E),
+        shape of (B,P,1+n+M,V) with n=0 if xs is None else 1
+        '''
+        m  = self.model
+        B,P = len(self.y),len(idx)
+        xs = [] if xs is None else [xs[:,:,None]]
+        if not (self.cache and m.cache_vocab_logp):
+            return m.vocab(torch.cat([self.z[:,idx,None]]+xs+[self.y[:,None].expand(B,P,-1,-1)],dim=2)).log_softmax(-1)
+        return torch.cat([self.lp_z()[:,idx,None]]+[m.vocab(x).log_softmax(-1) for x in xs]+[self.lp_y()[:,None].expand(B,P,-1,-1)],dim=2)
+
+class TraceRecorder(object):
+    '''
+    Records sel, xs, xp and the position of every _step into preallocated
+    CPU tensors of shape (n_step, N, ...), N summed over the recorded
+    batches, instead of printing them from callback_step.
+
+        rec = TraceRecorder().attach(model)
+        for item in dataloader: model.get_tokens(...)
+        rec.save('trace')   ### trace.{pos,sel,xs,xp}.npy
+
+    xs is the state at the current position (its slot for sweeps), xp is
+    the emission written to fs at that position. For the mixture models
+    sel holds log xp over chains. Buffers double when outgrown.
+    '''
+    def __init__(self,n_step=64,n_sample=256):
+        self.n_step   = n_step
+        self.n_sample = n_sample
+        self.pos  = torch.zeros((n_step,),dtype=torch.long)
+        self.bufs = {}
+        self.n = 0   ### samples of the finished batches
+        self.B = 0
+        self.t = 0   ### steps taken in the current batch
+        self.T = 0
+
+    def attach(self,model):
+        model.callback_init = self.init
+        model.callback_step = self
+        model.callback_end  = self.end
+        return self
+
+    def detach(self,model):
+        for k in ('callback_init','callback_step','callback_end'):
+            model.__dict__.pop(k,None)
+        return self
+
+    def init(self,outer):
+        self.B = outer[3].size(0)
+        self.t = 0
+
+    def end(self,outer):
+        self.n += self.B
+        self.T  = max(self.T,self.t)
+
+    @staticmethod
+    def _at(x,i):
+        if isinstance(x,SweepSlots):
+            return x.slots[i]
+        if isinstance(x,StepOutputs):
+            return x[-1]
+        return x[:,i:i+1]
+
+    def _reserve(self,T,N):
+        if T<=self.n_step and N<=self.n_sample:
+            return
+        T0,N0 = self.n_step,self.n_sample
+        self.n_step   = max(T,2*T0) if T>T0 else T0
+        self.n_sample = max(N,2*N0) if N>N0 else N0
+        pos = torch.zeros((self.n_step,),dtype=torch.long)
+        pos[:T0] = self.pos
+        self.pos = pos
+        for k,v in self.bufs.items():
+            buf = torch.zeros((self.n_step,self.n_sample)+v.shape[2:],dtype=v.dtype)
+            buf[:T0,:N0] = v
+            self.bufs[k] = buf
+
+    def __call__(self,outer,inner):
+        i = inner[0][0] if isinstance(inner[0],tuple) else inner[0]
+        xs = ([v for v in inner[2:] if isinstance(v,SweepSlots)] or [inner[3]])[0]
+        xs = xs.slots[i] if isinstance(xs,SweepSlots) else xs
+        vals = dict(sel=inner[1],xs=xs,xp=self._at(outer[4],i))
+        t,n,B = self.t,self.n,self.B
+        self._reserve(t+1,n+B)
+        self.pos[t] = i
+        for k,v in vals.items():
+            v = v.detach()
+            if k not in self.bufs:
+                self.bufs[k] = torch.zeros((self.n_step,self.n_sample)+v.shape[1:],dtype=v.dtype)
+            self.bufs[k][t,n:n+B].copy_(v,non_blocking=True)
+        self.t += 1
+
+    def tensors(self):
+        out = {k:v[:self.T,:self.n] for k,v in self.bufs.items()}
+        out['pos'] = self.pos[:self.T]
+        return out
+
+    def save(self,prefix):
+        import numpy as np
+        fns = []
+        for k,v in self.tensors().items():
+            fns.append(f'{prefix}.{k}.npy')
+            np.save(fns[-1],v.numpy())
+        return fns
+
+    @staticmethod
+    def load(prefix,mmap_mode='r'):
+        '''
+        {name: array} of a saved trace, memory-mapped by default
+        '''
+        import numpy as np
+        return {k:np.load(f'{prefix}.{k}.npy',mmap_mode=mmap_mode) for k in ('pos','sel','xs','xp')}
+
+def _grad_tensors(x):
+    ### tensors requiring grad in a (nested) outer/inner state
+    if torch.is_tensor(x):
+        return [x] if x.requires_grad else []
+    if isinstance(x,SweepSlots):
+        x = x.slots
+    if isinstance(x,(list,tuple)):
+        return [t for v in x for t in _grad_tensors(v)]
+    return []
+
+def _copy_state(x):
+    ### fresh containers around the same tensors, so that a probe run of
+    ### _step cannot mutate the caller's outer/inner
+    if isinstance(x,SweepSlots):
+        c = copy.copy(x)
+        c.slots = list(x.slots)
+        return c
+    if isinstance(x,StepOutputs):
+        return copy.copy(x)
+    if isinstance(x,(list,tuple)):
+        return type(x)(_copy_state(v) for v in x)
+    return x
+
+def _compile_errors():
+    ### what a failing torch.compile raises: dynamo's own errors, which also
+    ### wrap the backend ones (inductor, a missing C++ toolchain)
+    try:
+        import torch._dynamo.exc
+        return (torch._dynamo.exc.TorchDynamoException,)
+    except (ImportError,AttributeError):
+        return ()
+
+def compile_step(fn,probe=False):
+    '''
+    Wraps a _step with torch.compile. If torch.compile is missing, or
+    compiling the step fails (unsupported Python, no compiler toolchain),
+    it warns and falls back to eager fn for good. Errors of the step itself
+    are raised as usual.
+
+    AOTAutograd only compiles the backward on the first backward pass, so
+    a backward that fails to compile is not caught here. With probe=True
+    the first call under grad is preceded by a probe instead: the compiled
+    step runs on copies of outer/inner and is backpropagated to the
+    parameters (graph retained), falling back if that fails. This costs
+    one extra forward and backward, and graphs recompiled later for new
+    shapes are not probed again.
+
+    The inductor kernels are cached on disk. To keep them across runs,
+    set TORCHINDUCTOR_CACHE_DIR to a directory outside the source tree
+    before starting python.
+    '''
+    errors = _compile_errors()
+    if not hasattr(torch,'compile') or not errors:
+        return fn
+    try:
+        import torch._inductor.config
+        torch._inductor.config.fx_graph_cache = True
+    except (ImportError,AttributeError):
+        pass
+    state = {'f':torch.compile(fn,dynamic=True),'probed':not probe}
+    params = list(fn.__self__.parameters()) if isinstance(getattr(fn,'__self__',None),nn.Module) else []
+    def step(outer,inner):
+        if state['f'] is fn:
+            return fn(outer,inner)
+        try:
+            if not state['probed'] and torch.is_grad_enabled():
+                ### RNG forked so sampling steps draw the same as without the probe
+                with torch.random.fork_rng():
+                    ts = _grad_tensors(state['f'](_copy_state(outer),_copy_state(inner)))
+                    ps = [p for p in params if p.requires_grad]
+                    if ts and ps:
+                        torch.autograd.grad(sum(t.float().sum() for t in ts),ps,retain_graph=True,allow_unused=True)
+                state['probed'] = True
+            return state['f'](outer,inner)
+        except errors as e:
+            warnings.warn(f'compile_steps: running {fn.__qualname__} eagerly, {e!r}')
+            state['f'] = fn
+            return fn(outer,inner)
+    return step
+
+def additive_window_states(model,z,xs):
+    '''
+    Hidden states of the RefillModelRNNAdditive step for all positions.
+    From i>=2 the step rebuilds the state from z[:,i-2], so only the first
+    two positions depend on the previous state.
+    :type z:  shape of (B,L,E)
+    :type xs: initial state, shape of (B,1,E)
+    Returns shape of (B,L,E)
+    '''
+    T,U,L = model.transition,model.updater,z.size(1)
+    out = []
+    for i in range(min(L,2)):
+        xs = model.norm(T(xs) + U(z[:,i:i+1]))
+        out.append(xs)
+    if L>2:
+        out.append(model.norm(T(T(z[:,:-2])) + U(z[:,2:])))
+    return torch.cat(out,dim=1)
+
+
 class RefillModelRNNBase(nn.Module):
     '''
     Symbolic Module that defines Loss function
@@ -54,6 +413,14 @@ class RefillModelRNNBase(nn.Module):
     def callback_end(self,outer):
         return
         # self.callback_init = lambda zi,x,y,z,sel: None
+    def _get_callback(self):
+        '''
+        callback_step, or None if neither the class nor the instance
+        overrides the no-op above, so the loops can skip the call.
+        '''
+        if 'callback_step' not in self.__dict__ and type(self).callback_step is RefillModelRNNBase.callback_step:
+            return None
+        return self.callback_step
 
     def nembed(self,y):
         y = self.embed(y)
@@ -78,12 +445,265 @@ class RefillModelRNNBase(nn.Module):
     def get_tokens(self,zi,x,y,z):
         return self._loss(zi,x,y,z,out='token')
 
+    def grad_loss(self,zi,x,y,z):
+        return self._loss(zi,x,y,z,out='grad_loss')
+
+    def forward_all(self,zi,x,y,z,outputs=('loss','grad_loss','token'),lengths=None,ids=None):
+        '''
+        {name: value} of every requested output from a single forward pass,
+        instead of one pass per loss()/grad_loss()/get_tokens() call.
+        :param lengths: shape of (B,), true lengths of the rows of a
+            var_len batch. The padding is left out of the loss and is
+            never read by the positions of the row, see BatchContext.right()
+        :param ids: shape of (B,), item['sentence_id'], keys the reward
+            baseline of the sampling models
+        '''
+        kw = {} if ids is None else dict(ids=ids)
+        return self._loss(zi,x,y,z,out=tuple(outputs),lengths=lengths,**kw)
+
+    @staticmethod
+    def _token_mean(v,lengths=None):
+        '''
+        Mean over the last (position) dim, of the first lengths positions
+        of each row if lengths (B,) is given.
+        :type v: shape of (B,...,L)
+        '''
+        if lengths is None:
+            return v.mean(-1)
+        L = v.size(-1)
+        valid = torch.arange(L,device=v.device) < lengths.to(v.device).reshape((-1,)+(1,)*(v.dim()-1))
+        return (v*valid).sum(-1)/valid.sum(-1).clamp(min=1)
+
+    @staticmethod
+    def _outs(out):
+        return (out,) if isinstance(out,str) else tuple(out)
+
+    def _pick(self,out,**vals):
+        '''
+        vals[out] for a single name, {name: vals[name]} for a tuple of names.
+        grad_loss is loss unless the model has a surrogate for it.
+        '''
+        vals.setdefault('grad_loss',vals.get('loss'))
+        if isinstance(out,str):
+            return vals[out]
+        return {k:vals[k] for k in out}
+
     def _step(self,outer,inner):
         '''
         Outer should be non-mutable?
         '''
         return outer,inner
 
+    ### set False to recompute the BatchContext quantities on every step
+    batch_context = True
+    ### set False to project all of [z_i, xs, y] onto the vocab every step
+    cache_vocab_logp = True
+    ctx = None
+    def _batch_context(self,outer,lengths=None):
+        return BatchContext(self,outer[2],outer[3],cache=self.batch_context,lengths=lengths)
+
+    ### set False to fall back to growing fs with torch.cat on every step
+    buffered_steps = True
+    def _append_step(self,fs,xq,dim=1):
+        if isinstance(fs,StepOutputs):
+            fs.dim = dim
+            fs.append(xq)
+            return fs
+        return torch.cat([fs,xq],dim=dim)
+
+    def _run_steps(self,outer,inner,L,dim=1):
+        '''
+        Runs _step over L positions with callbacks.
+        An empty fs from _batch_init is collected as StepOutputs, so the
+        (B,L,...) output is built by a single concatenation: O(L) copies
+        instead of O(L^2). Preallocated fs (the sweeping models) is left as is.
+        Models defining _forward_parallel compute all positions at once
+        instead, unless a callback_step is registered.
+        '''
+        self.ctx = self._batch_context(outer)
+        step = self._get_step()
+        callback = self._get_callback()
+        self.callback_init(outer)
+        if self.parallel_forward and self._forward_parallel is not None and callback is None:
+            outer,inner = self._forward_parallel(outer,inner)
+        else:
+            if self.buffered_steps and torch.is_tensor(outer[4]) and outer[4].numel()==0:
+                outer[4] = StepOutputs(dim)
+            for i in range(L):
+                inner[0]=i
+                outer,inner = step(outer,inner) #### do what ever with your hidden state
+                if callback is not None:
+                    callback(outer,inner)
+            if isinstance(outer[4],StepOutputs):
+                outer[4] = outer[4].tensor()
+        self.ctx = None
+        self.callback_end(outer)
+        return outer,inner
+
+    ### set True to run _step through torch.compile, see compile_step()
+    compile_steps = False
+    ### set True to check the compiled backward up front, see compile_step()
+    compile_probe = False
+    def _get_step(self):
+        if not self.compile_steps:
+            return self._step
+        if self.__dict__.get('_step_compiled') is None:
+            self._step_compiled = compile_step(self._step,probe=self.compile_probe)
+        return self._step_compiled
+
+    ### set False to run the step loop even where _forward_parallel exists
+    parallel_forward = True
+    _forward_parallel = None
+
+    ### set False to fall back to torch.scatter into full tensors
+    slot_sweeps = True
+    def _put_slot(self,xa,i,v):
+        if isinstance(xa,SweepSlots):
+            return xa.put(i,v)
+        return torch.scatter(xa,index=(v*0).long()+i,src=v,dim=1)
+
+    def _full(self,xa):
+        return xa.tensor() if isinstance(xa,SweepSlots) else xa
+
+    def _run_sweeps(self,outer,inner,sweeps,inner_slots=(3,),lengths=None):
+        '''
+        Runs _step for every inner[0] value of each sweep, with callbacks.
+        fs (outer[4]) and the per-position states at inner[inner_slots]
+        are held as SweepSlots during the sweeps and materialised at the end,
+        so backprop keeps O(sweeps*L) slots instead of O(sweeps*L) full copies.
+        With max_sweeps set the sweep count adapts per row instead.
+        lengths (B,) of a padded batch are passed on to the BatchContext.
+        '''
+        if self.max_sweeps is not None:
+            return self._run_sweeps_adaptive(outer,inner,sweeps,inner_slots,lengths)
+        step = self._get_step()
+        callback = self._get_callback()
+        self.callback_init(outer)
+        outer,inner = self._sweeps(outer,inner,sweeps,inner_slots,step,callback,lengths)
+        self._count_sweeps(torch.full((len(outer[3]),),len(sweeps)))
+        self.callback_end(outer)
+        return outer,inner
+
+    def _sweeps(self,outer,inner,sweeps,inner_slots,step,callback,lengths=None):
+        if self.slot_sweeps:
+            outer[4] = SweepSlots(outer[4])
+            for k in inner_slots:
+                inner[k] = SweepSlots(inner[k])
+        self.ctx = self._batch_context(outer,lengths)
+        for sweep in sweeps:
+            for v in sweep:
+                inner[0]=v
+                outer,inner = step(outer,inner) #### do what ever with your hidden state
+                if callback is not None:
+                    callback(outer,inner)
+        outer[4] = self._full(outer[4])
+        for k in inner_slots:
+            inner[k] = self._full(inner[k])
+        self.ctx = None
+        return outer,inner
+
+    ### adaptive sweeps: with max_sweeps set, the sweeps are cycled until
+    ### every row has converged to within sweep_tol, see _run_sweeps_adaptive
+    max_sweeps = None
+    sweep_tol  = 1e-3
+    sweep_rows  = 0
+    sweep_total = 0
+
+    def _run_sweeps_adaptive(self,outer,inner,sweeps,inner_slots,lengths=None):
+        '''
+        Cycles through sweeps, at most max_sweeps of them. A row has
+        converged once no value of fs or of inner[inner_slots] moved by more
+        than sweep_tol over the last sweep; it is then frozen and later
+        sweeps run on the remaining rows only. Step callbacks, which
+        expect the full batch (e.g. TraceRecorder), are not supported.
+        '''
+        step = self._get_step()
+        callback = self._get_callback()
+        if callback is not None:
+            raise Exception(f'callback_step is not supported with max_sweeps={self.max_sweeps}, set max_sweeps=None to record steps')
+        self.callback_init(outer)
+        B = len(outer[3])
+        active = torch.arange(B,device=outer[3].device)
+        ### sweeps run by each row
+        n_sweeps = torch.zeros((B,),dtype=torch.long,device=active.device)
+        for n in range(self.max_sweeps):
+            sub_outer = [v[active] for v in outer]
+            sub_inner = [v[active] if torch.is_tensor(v) else v for v in inner]
+            old = [sub_outer[4]]+[sub_inner[k] for k in inner_slots]
+            sub_lengths = None if lengths is None else lengths.to(active.device)[active]
+            sub_outer,sub_inner = self._sweeps(sub_outer,sub_inner,[sweeps[n%len(sweeps)]],inner_slots,step,callback,sub_lengths)
+            new = [sub_outer[4]]+[sub_inner[k] for k in inner_slots]
+
+            outer[4] = outer[4].index_copy(0,active,sub_outer[4])
+            for k in inner_slots:
+                inner[k] = inner[k].index_copy(0,active,sub_inner[k])
+            n_sweeps[active] += 1
+
+            delta = torch.stack([(a-b).detach().abs().flatten(1).max(1)[0] for a,b in zip(new,old)],0).max(0)[0]
+            active = active[delta > self.sweep_tol]
+            if not len(active):
+                break
+        self._count_sweeps(n_sweeps)
+        self.callback_end(outer)
+        return outer,inner
+
+    def _count_sweeps(self,n_sweeps):
+        ### n_sweeps: sweeps run by each row of a batch, shape of (B,)
+        self.sweep_rows  += len(n_sweeps)
+        self.sweep_total += int(n_sweeps.sum())
+
+    def sweep_stats(self,reset=False):
+        '''
+        (rows, average sweeps per row) over the runs since the last reset
+        '''
+        v = (self.sweep_rows,self.sweep_total/max(self.sweep_rows,1))
+        if reset:
+            self.sweep_rows = self.sweep_total = 0
+        return v
+
+    ### 'checkerboard' runs the ICM models through _run_checkerboard
+    ### instead of sequential sweeps, where they define _step_colour
+    sweep_schedule = 'sequential'
+    checkerboard_rounds = 3
+
+    def _neighbours(self,xa,idx):
+        '''
+        (left, right) neighbours of the positions idx in xa (B,L,...),
+        zero where they fall off either end of the row
+        '''
+        L = xa.size(1)
+        shape = (1,len(idx))+(1,)*(xa.dim()-2)
+        xl = xa[:,(idx-1).clamp(min=0)] * (idx>=1).reshape(shape).to(xa.dtype)
+        xr = xa[:,(idx+1).clamp(max=L-1)] * (idx+1<=L-1).reshape(shape).to(xa.dtype)
+        return xl,self.ctx.right(idx,xr)
+
+    def _run_checkerboard(self,outer,inner,L,lrs=None,lengths=None):
+        '''
+        Red-black schedule: each round updates all even positions with one
+        _step_colour call, then all odd ones. Positions of one colour are
+        never adjacent, so each update only reads neighbours of the other
+        colour, as in Gibbs sampling on a chain. Runs 2*checkerboard_rounds
+        batched steps instead of sweeps*L single-position ones.
+
+        :param lrs: propagation direction of each round, for the mixture
+            models. inner[0] is then (idx,lr) instead of idx.
+
+        callback_step is not called, inner[0] holds many positions here.
+        The round count is fixed, adaptive max_sweeps is not supported.
+        '''
+        if self.max_sweeps is not None:
+            raise Exception(f'max_sweeps={self.max_sweeps} is not supported with sweep_schedule=checkerboard, set max_sweeps=None')
+        self.ctx = self._batch_context(outer,lengths)
+        self.callback_init(outer)
+        dev = outer[3].device
+        colours = [torch.arange(c,L,2,device=dev) for c in (0,1) if c<L]
+        for r in range(self.checkerboard_rounds):
+            for idx in colours:
+                inner[0] = idx if lrs is None else (idx,lrs[r%len(lrs)])
+                outer,inner = self._step_colour(outer,inner)
+        self.ctx = None
+        self.callback_end(outer)
+        return outer,inner
 
     def _batch_init(self,zi,x,y,z):
         #### batch_init part
@@ -105,17 +725,12 @@ class RefillModelRNNBase(nn.Module):
         inner = [i,sel,xz,xs]
         return outer,inner
 
-    def _loss(self,zi,x,y,z,out='loss'):
-        assert out in 'loss token traj'.split()
+    def _loss(self,zi,x,y,z,out='loss',lengths=None):
+        assert set(self._outs(out)) <= set('loss token traj grad_loss'.split())
 
         outer,inner = self._batch_init(zi,x,y,z)
         ### Uses an explicit RNN to switch between copying z and extract y
-        self.callback_init(outer)
-        for i in range(z.size(1)):
-            inner[0]=i
-            outer,inner = self._step(outer,inner) #### do what ever with your hidden state
-            self.callback_step(outer,inner)
-        self.callback_end(outer)
+        outer,inner = self._run_steps(outer,inner,z.size(1))
         (zi,x,y,z,fs) = outer
 
 
@@ -126,10 +741,7 @@ class RefillModelRNNBase(nn.Module):
 
         cent  = self.target_energy(lptok,x)
 
-        if out=='loss': return -cent.mean(-1)
-        assert 0
-
-    grad_loss = loss
+        return self._pick(out,loss=-self._token_mean(cent,lengths),token=lptok)
 
     def corrupt(self,zi,y):
         # self.sigma = 1.5
@@ -237,7 +849,7 @@ class RefillModelRNNAdditive(RefillModelRNNBase):
         sel = self.selector(xs).softmax(-1)
         ### maybe make query vector a function of state?
         # cand
-        cand = self.selector_q.weight[None].matmul(self.selector_k(y).transpose(2,1)).softmax(-1).matmul(y)
+        cand = self.ctx.cand()
         # cand = self.selector_q(xs).reshape((len(xs),-1,self.embed_dim)).matmul(self.selector_k(y).transpose(2,1)).softmax(-1).matmul(y)
         # cand = torch.cat([xz,cand[:,1:]],dim=1)
         cand = torch.cat([xz,xs,cand[:,2:]],dim=1)
@@ -246,11 +858,25 @@ class RefillModelRNNAdditive(RefillModelRNNBase):
         # xs = xs + self.transition(xs) + self.updater(xq)
         # xs = self.norm(xs)
 
-        fs   = torch.cat([fs,xq],dim=1)
+        fs   = self._append_step(fs,xq)
         outer = [zi,x,y,z,fs]
         inner = [i,sel,xz,xs]
         return outer,inner
 
+    def _forward_parallel(self,outer,inner):
+        '''
+        _step for all positions at once, see additive_window_states()
+        '''
+        (zi,x,y,z,fs) = outer
+        xs   = additive_window_states(self,z,inner[3])
+        sel  = self.selector(xs).softmax(-1)
+        ### candidates are [z_i, xs_i, cand[:,2:]]
+        cand = self.ctx.cand()[:,2:]
+        fs   = sel[:,:,0:1]*z + sel[:,:,1:2]*xs + sel[:,:,2:].matmul(cand)
+        outer = [zi,x,y,z,fs]
+        inner = [z.size(1)-1,sel[:,-1:],z[:,-1:],xs[:,-1:]]
+        return outer,inner
+
 
 class RefillModelRNNAdditiveWithPseudoSampling(RefillModelRNNBase):
     def __init__(self,
@@ -352,7 +978,7 @@ class RefillModelRNNAdditiveWithPseudoSampling(RefillModelRNNBase):
         # sel = self.selector_2(xs).relu()
         ### maybe make query vector a function of state?
         # cand
-        cand = self.selector_q.weight[None].matmul(self.selector_k(y).transpose(2,1)).softmax(-1).matmul(y)
+        cand = self.ctx.cand()
         # cand = self.selector_q(xs).reshape((len(xs),-1,self.embed_dim)).matmul(self.selector_k(y).transpose(2,1)).softmax(-1).matmul(y)
         # cand = torch.cat([xz,cand[:,1:]],dim=1)
         cand = torch.cat([xz,xs,cand[:,2:]],dim=1)
@@ -365,32 +991,43 @@ class RefillModelRNNAdditiveWithPseudoSampling(RefillModelRNNBase):
         xq    = (lptok+sel.transpose(2,1)).logsumexp(1,keepdims=True)
         # cent  = (cent+sel[:,0]).logsumexp(-1,keepdims=True)
         # mean(-1,keepdims=True)
-        fs    = torch.cat([fs,xq],dim=1)
+        fs    = self._append_step(fs,xq)
 
         outer = [zi,x,y,z,fs]
         inner = [i,sel,xz,xs]
         return outer,inner
 
-    def _loss(self,zi,x,y,z,out='loss'):
-        assert out in 'loss token traj'.split()
+    def _forward_parallel(self,outer,inner):
+        '''
+        _step for all positions at once, see additive_window_states()
+        '''
+        (zi,x,y,z,fs) = outer
+        xs   = additive_window_states(self,z,inner[3])
+        sel  = self.selector(xs).log_softmax(-1)
+        B,L,K = sel.shape
+        ### log-probs of the candidates [z_i, xs_i, cand[:,2:]], shape of (B,L,K,V)
+        lpc  = self.vocab(self.ctx.cand()[:,2:]).log_softmax(-1)
+        lptok = torch.cat([
+            self.ctx.lp_z()[:,:,None],
+            self.vocab(xs).log_softmax(-1)[:,:,None],
+            lpc[:,None].expand((B,L)+lpc.shape[1:])],dim=2)
+        fs   = (lptok+sel[:,:,:,None]).logsumexp(2)
+        outer = [zi,x,y,z,fs]
+        inner = [L-1,sel[:,-1:],z[:,-1:],xs[:,-1:]]
+        return outer,inner
+
+    def _loss(self,zi,x,y,z,out='loss',lengths=None):
+        assert set(self._outs(out)) <= set('loss token traj grad_loss'.split())
 
         outer,inner = self._batch_init(zi,x,y,z)
         ### Uses an explicit RNN to switch between copying z and extract y
-        self.callback_init(outer)
-        for i in range(z.size(1)):
-            inner[0]=i
-            outer,inner = self._step(outer,inner) #### do what ever with your hidden state
-            self.callback_step(outer,inner)
-        self.callback_end(outer)
+        outer,inner = self._run_steps(outer,inner,z.size(1))
         (zi,x,y,z,lptok) = outer
 
         cent = self.target_energy(lptok,x)
-        loss  = -cent.mean(-1)
+        loss  = -self._token_mean(cent,lengths)
         # if out=='token': return lptok
-        if out=='token': return lptok
-
-        if out=='loss': return loss
-        assert 0
+        return self._pick(out,loss=loss,token=lptok)
 
 
 class RefillModelRNNAdditiveDirect(RefillModelRNNBase):
@@ -493,9 +1130,7 @@ class RefillModelRNNAdditiveDirect(RefillModelRNNBase):
         ### under a projection matrix
         ### This should allow a direction interaction between hidden and
         ### the output
-        xkey_static = self.xkey_static.weight[None,:2,:self.embed_dim].repeat((len(z),1,1))
-        xkey_dynamic= self.xkey_dynamic(y)
-        xkey = torch.cat([xkey_static, xkey_dynamic],dim=1)
+        xkey  = self.ctx.xkey(2)
         sel = xs.matmul(xkey.transpose(2,1)).softmax(-1)
         cand = torch.cat([xz,xs,y],dim=1)
         xq   = sel.matmul(cand)
@@ -505,7 +1140,7 @@ class RefillModelRNNAdditiveDirect(RefillModelRNNBase):
 
         # xs = xs + self.transition(xs) + self.updater(xq)
         # xs = self.norm(xs)
-        fs   = torch.cat([fs,xq],dim=1)
+        fs   = self._append_step(fs,xq)
         outer = [zi,x,y,z,fs]
         inner = [i,sel,xz,xs]
         return outer,inner
@@ -556,12 +1191,26 @@ class RefillModelRNNAdditiveDirectSampling(RefillModelRNNBase):
         self.updater    = nn.Linear(embed_dim,embed_dim).to(self.device)
         self.fs_type    = 'sampled_traj'
         self.K = 100
+        self.reward_baseline = RunningBaseline(total_length).to(self.device)
 
-    def _batch_init(self,zi,x,y,z):
+    ### REINFORCE estimator of grad_loss, see util_sample.reinforce_objective
+    reinforce = 'none'
+
+    ### run the K chains in chunks of this many. Each chunk is recomputed
+    ### in backward (torch.utils.checkpoint), so only one chunk's graph is
+    ### alive at a time while the REINFORCE terms accumulate over chunks.
+    chain_chunk = None
+
+    def _batch_init(self,zi,x,y,z,k=None):
+        '''
+        The reservoir is a single (B,M,E) table shared by all k chains,
+        chain k having erased the slots set in bit m of used[:,k].
+        :type used: shape of (B,k), int64 bitmask
+        '''
         ### k is number of chain
         #### batch_init part
         ### state init
-        k = self.K
+        k = self.K if k is None else k
         z = self.embed(z)
         B = y.size(0)
         self.max_mem = M = 9
@@ -569,7 +1218,6 @@ class RefillModelRNNAdditiveDirectSampling(RefillModelRNNBase):
         ### construct reservoir
         y = self.embed(y)
         y = torch.cat([y,self.embed_extra(torch.zeros((B, M -y.shape[1])).long().to(self.device)) ],dim=1)
-        y = y[:,None].repeat((1,k,1,1))
 
         # xs = torch.cat([y,init_state],dim=1)
         xs = self.init_state.weight.T[None,0:1]
@@ -586,10 +1234,18 @@ class RefillModelRNNAdditiveDirectSampling(RefillModelRNNBase):
         sel = None
         # xz = None
         lp = 0*xs[:,:,0]
+        used = torch.zeros((B,k),dtype=torch.long,device=self.device)
         outer = [zi,x,y,z,fs]
-        inner = [i,sel,lp,xs]
+        inner = [i,sel,(lp,used),xs]
         return outer,inner
 
+    def _consumed(self,used):
+        '''
+        bool (B,K,M) of the slots each chain has erased, from the bitmask
+        '''
+        bits = 2**torch.arange(self.max_mem,device=used.device)
+        return torch.div(used[:,:,None],bits,rounding_mode='floor') % 2 == 1
+
     def _step(self,outer,inner):
         '''
 
@@ -621,13 +1277,13 @@ class RefillModelRNNAdditiveDirectSampling(RefillModelRNNBase):
         '''
 
         (zi,x,y,z,fs) = outer
-        (i,sel,lp,xs) = inner
+        (i,sel,(lp,used),xs) = inner
 
         ### xs needs to be expanded into
         sel = None
         xz  = None
 
-        K = self.K
+        K = xs.size(1)
         B = len(xs)
         E = self.embed_dim
         M = self.max_mem
@@ -647,36 +1303,40 @@ class RefillModelRNNAdditiveDirectSampling(RefillModelRNNBase):
         ### the output
 
         ## static keys are shared
-        xkey_static = self.xkey_static.weight[None,None, :2,:self.embed_dim].repeat((len(z),K,1,1))
-
-        ### dynamic keys are dependent on the
-        xkey_dynamic= self.xkey_dynamic(y)
-        xkey  = torch.cat([xkey_static, xkey_dynamic],dim=2)
+        xkey_static = self.xkey_static.weight[:2,:self.embed_dim]
 
+        ### dynamic keys are dependent on the reservoir: computed once
+        ### for the shared table, erased slots all carry the erase vector
+        xerase = self.embed_extra.weight[0]
+        xkey_dynamic = self.ctx.xkey_dynamic()
+        consumed = self._consumed(used)
+        sel_dynamic = torch.where(consumed,
+            xs.matmul(self.xkey_dynamic(xerase))[:,:,None],
+            xs.matmul(xkey_dynamic.transpose(2,1)))
 
         ### calculate actions
-        ### einsum maybe slow, but maybe reshape?
-        sel   = xs .reshape((B*K,-1,E)).matmul(xkey.reshape((B*K,-1,E)).transpose(2,1))
+        sel   = torch.cat([xs.matmul(xkey_static.T), sel_dynamic],dim=2)
         # sel   = sel / 0.1
         sel   = sel.log_softmax(-1)
-        sel   = sel.reshape((B,K,-1))
-        cand  = torch.cat([ xz[:,None].repeat((1,K,1,1)),xs[:,:,None],y],dim=2)
         ###
 
         ### performs random sampling and record loglp
         ### temperature should be a parameter?
-        xpc = sel.exp().cumsum(-1)
-        xr = torch.rand(sel.shape[:-1]+(1,)).to(self.device)
-        _ ,xi = (xr<=xpc).max(dim=-1)
+        xi = sample_categorical(sel)
 
         lp = lp + torch.gather(sel,index=xi[:,:,None],dim=-1)[:,:,0]
 
-        #### modify reservoir to erase accessed memory
-        xq = torch.gather(cand,index=xi[:,:,None,None].repeat((1,1,1,E)),dim=2)
+        #### candidates are [xz, xs, reservoir], read the chosen one
+        m  = (xi-2).clamp(min=0)
+        xq = torch.gather(y,index=m[:,:,None].expand(-1,-1,E),dim=1)
+        xq = torch.where(torch.gather(consumed,index=m[:,:,None],dim=2),xerase,xq)
+        xq = torch.where((xi==1)[:,:,None],xs,xq)
+        xq = torch.where((xi==0)[:,:,None],xz.expand(-1,K,-1),xq)
+        xq = xq[:,:,None]
 
+        #### modify reservoir to erase accessed memory
         xi = (xi - 2)% self.max_mem
-        # 0.3980,  1.7758, -0.6467,
-        y = torch.scatter(y,index=xi[:,:,None,None].repeat((1,1,1,E)),dim=2,src=self.embed_extra.weight[0:1,None,None,:].repeat((B,K,1,1)))
+        used = used | 2**xi
         # y = self.norm(y)
 
 
@@ -690,9 +1350,9 @@ class RefillModelRNNAdditiveDirectSampling(RefillModelRNNBase):
         #### indeed it's much better to not aggregate the expectation
 
         #### fs represents lptok
-        fs   = torch.cat([fs,xq],dim=2)
+        fs   = self._append_step(fs,xq,dim=2)
         outer = [zi,x,y,z,fs]
-        inner = [i,sel,lp,xs]
+        inner = [i,sel,(lp,used),xs]
         return outer,inner
 
 
@@ -700,40 +1360,55 @@ class RefillModelRNNAdditiveDirectSampling(RefillModelRNNBase):
         return self._loss(zi,x,y,z,out='loss')
     # grad_loss = loss
 
-    def _loss(self,zi,x,y,z,out='loss'):
-        assert out in 'loss token traj grad_loss'.split()
-
-        outer,inner = self._batch_init(zi,x,y,z)
+    def _chains(self,zi,x,y,z,k):
+        '''
+        Samples k chains, returns lptok (B,k,L,V), xc (B,k,L) and lp (B,k)
+        '''
+        outer,inner = self._batch_init(zi,x,y,z,k)
         ### Uses an explicit RNN to switch between copying z and extract y
-        self.callback_init(outer)
-        for i in range(z.size(1)):
-            inner[0]=i
-            outer,inner = self._step(outer,inner) #### do what ever with your hidden state
-            self.callback_step(outer,inner)
-        self.callback_end(outer)
+        outer,inner = self._run_steps(outer,inner,z.size(1))
         (zi,x,y,z, sampled_traj) = outer
-        (i,sel,lp,xs) = inner
+        (i,sel,(lp,used),xs) = inner
         lptok = self.vocab(sampled_traj).log_softmax(-1)
-        xc = cent  = torch.gather(lptok,index=x[:,None,:,None].repeat((1,self.K,1,1)),dim=-1).mean((-1))
+        xc = torch.gather(lptok,index=x[:,None,:,None].expand(-1,k,-1,1),dim=-1).mean((-1))
+        return lptok,xc,lp
+
+    def _loss(self,zi,x,y,z,out='loss',lengths=None,ids=None):
+        assert set(self._outs(out)) <= set('loss token traj grad_loss'.split())
+
+        K = self.K
+        C = self.chain_chunk or K
+        want_token = 'token' in self._outs(out)
+        lptoks,xcs,lps = [],[],[]
+        for k0 in range(0,K,C):
+            k = min(C,K-k0)
+            if C<K and not want_token and torch.is_grad_enabled():
+                xc,lp = checkpoint(lambda z,k=k: self._chains(zi,x,y,z,k)[1:],z,use_reentrant=False)
+            else:
+                lptok,xc,lp = self._chains(zi,x,y,z,k)
+                if want_token:
+                    lptoks.append(lptok)
+            xcs.append(xc)
+            lps.append(lp)
+        xc = cent = torch.cat(xcs,dim=1)
+        lp    = torch.cat(lps,dim=1)
+        lptok = torch.cat(lptoks,dim=1) if want_token else None
         # import pdb; pdb.set_trace()
 
-        if out == 'grad_loss':
-            ## REINFORCE
-            wloss = xc.mean(-1) * lp
-            # wloss = xc.mean(-1)/
-            # wloss = -xc.mean(-1) * lp.log_softmax(-1)
-            # wloss = -xc.mean(-1) * lp.softmax(-1)
-            return wloss
+        ## REINFORCE
+        reward = self._token_mean(xc,lengths)
+        ### keyed by sentence id, zi restarts from 0 on the test split
+        ema = self.reinforce=='ema' and 'grad_loss' in self._outs(out)
+        b = self.reward_baseline(zi if ids is None else ids,reward) if ema else None
+        wloss = reinforce_objective(reward,lp,self.reinforce,b)
+        # wloss = xc.mean(-1)/
+        # wloss = -xc.mean(-1) * lp.log_softmax(-1)
+        # wloss = -xc.mean(-1) * lp.softmax(-1)
         # cent = self.target_energy(lptok,x)
         # loss  = -cent.mean(-1)
-        loss  = -xc.mean(-1)
+        loss  = -self._token_mean(xc,lengths)
         # if out=='token': return lptok
-        if out=='token': return lptok
-
-        if out=='loss': return loss
-        assert 0
-    def grad_loss(self,zi,x,y,z):
-        return self._loss(zi,x,y,z,out='grad_loss')
+        return self._pick(out,loss=loss,grad_loss=wloss,token=lptok)
 
 
 
@@ -824,14 +1499,11 @@ class RefillModelRNNAdditiveDirectMixing(RefillModelRNNBase):
         ### under a projection matrix
         ### This should allow a direction interaction between hidden and
         ### the output
-        xkey_static = self.xkey_static.weight[None,:2,:self.embed_dim].repeat((len(z),1,1))
-        xkey_dynamic= self.xkey_dynamic(y)
-        xkey  = torch.cat([xkey_static, xkey_dynamic],dim=1)
+        xkey  = self.ctx.xkey(2)
 
 
         sel   = xs.matmul(xkey.transpose(2,1)).log_softmax(-1)
-        cand  = torch.cat([xz,xs,y],dim=1)
-        lptok = self.vocab(cand).log_softmax(-1)
+        lptok = self.ctx.cand_logp(i,xs)
 
         xq    = (lptok+sel.transpose(2,1)).logsumexp(1,keepdims=True)
         #### I think the expectation aggregation here is too harsh...
@@ -840,33 +1512,25 @@ class RefillModelRNNAdditiveDirectMixing(RefillModelRNNBase):
         #### indeed it's much better to not aggregate the expectation
 
         #### fs represents lptok
-        fs   = torch.cat([fs,xq],dim=1)
+        fs   = self._append_step(fs,xq)
         outer = [zi,x,y,z,fs]
         inner = [i,sel,xz,xs]
         return outer,inner
 
 
 
-    def _loss(self,zi,x,y,z,out='loss'):
-        assert out in 'loss token traj'.split()
+    def _loss(self,zi,x,y,z,out='loss',lengths=None):
+        assert set(self._outs(out)) <= set('loss token traj grad_loss'.split())
 
         outer,inner = self._batch_init(zi,x,y,z)
         ### Uses an explicit RNN to switch between copying z and extract y
-        self.callback_init(outer)
-        for i in range(z.size(1)):
-            inner[0]=i
-            outer,inner = self._step(outer,inner) #### do what ever with your hidden state
-            self.callback_step(outer,inner)
-        self.callback_end(outer)
+        outer,inner = self._run_steps(outer,inner,z.size(1))
         (zi,x,y,z,lptok) = outer
 
         cent = self.target_energy(lptok,x)
-        loss  = -cent.mean(-1)
+        loss  = -self._token_mean(cent,lengths)
         # if out=='token': return lptok
-        if out=='token': return lptok
-
-        if out=='loss': return loss
-        assert 0
+        return self._pick(out,loss=loss,token=lptok)
 
 
 class RefillModelRNNAdditiveDirectMixingWithGate(RefillModelRNNBase):
@@ -955,14 +1619,11 @@ class RefillModelRNNAdditiveDirectMixingWithGate(RefillModelRNNBase):
         ### under a projection matrix
         ### This should allow a direction interaction between hidden and
         ### the output
-        xkey_static = self.xkey_static.weight[None,:2,:self.embed_dim].repeat((len(z),1,1))
-        xkey_dynamic= self.xkey_dynamic(y)
-        xkey  = torch.cat([xkey_static, xkey_dynamic],dim=1)
+        xkey  = self.ctx.xkey(2)
 
 
         sel   = xs.matmul(xkey.transpose(2,1)).log_softmax(-1)
-        cand  = torch.cat([xz,xs,y],dim=1)
-        lptok = self.vocab(cand).log_softmax(-1)
+        lptok = self.ctx.cand_logp(i,xs)
 
         xq    = (lptok+sel.transpose(2,1)).logsumexp(1,keepdims=True)
         #### I think the expectation aggregation here is too harsh...
@@ -971,33 +1632,25 @@ class RefillModelRNNAdditiveDirectMixingWithGate(RefillModelRNNBase):
         #### indeed it's much better to not aggregate the expectation
 
         #### fs represents lptok
-        fs   = torch.cat([fs,xq],dim=1)
+        fs   = self._append_step(fs,xq)
         outer = [zi,x,y,z,fs]
         inner = [i,sel,xz,xs]
         return outer,inner
 
 
 
-    def _loss(self,zi,x,y,z,out='loss'):
-        assert out in 'loss token traj'.split()
+    def _loss(self,zi,x,y,z,out='loss',lengths=None):
+        assert set(self._outs(out)) <= set('loss token traj grad_loss'.split())
 
         outer,inner = self._batch_init(zi,x,y,z)
         ### Uses an explicit RNN to switch between copying z and extract y
-        self.callback_init(outer)
-        for i in range(z.size(1)):
-            inner[0]=i
-            outer,inner = self._step(outer,inner) #### do what ever with your hidden state
-            self.callback_step(outer,inner)
-        self.callback_end(outer)
+        outer,inner = self._run_steps(outer,inner,z.size(1))
         (zi,x,y,z,lptok) = outer
 
         cent = self.target_energy(lptok,x)
-        loss  = -cent.mean(-1)
+        loss  = -self._token_mean(cent,lengths)
         # if out=='token': return lptok
-        if out=='token': return lptok
-
-        if out=='loss': return loss
-        assert 0
+        return self._pick(out,loss=loss,token=lptok)
 
 
 class RefillModelRNNAdditiveDirectMixingBidirectional(RefillModelRNNBase):
@@ -1084,7 +1737,7 @@ class RefillModelRNNAdditiveDirectMixingBidirectional(RefillModelRNNBase):
             # xg = xs.matmul(self.transition_gate.weight).matmul(xsl.transpose(2,1)).sigmoid()
             xs = xs + xg * xsl.matmul(self.transition.weight)
         if i+1<=L-1:
-            xsl = xsa[:,i+1:i+2]
+            xsl = self.ctx.right(i,xsa[:,i+1:i+2])
             xg = 1
             # xg = xsl.matmul(self.transition_gate.weight).matmul(xs.transpose(2,1)).sigmoid()
             xs = xs + xg * xsl.matmul(self.transition.weight.transpose(1,0  ))
@@ -1092,55 +1745,66 @@ class RefillModelRNNAdditiveDirectMixingBidirectional(RefillModelRNNBase):
         xs = xs + self.updater(xz)
         xs = self.norm(xs)
 
-        xkey_static = self.xkey_static.weight[None,:2,:self.embed_dim].repeat((len(z),1,1))
-        xkey_dynamic= self.xkey_dynamic(y)
-        xkey  = torch.cat([xkey_static, xkey_dynamic],dim=1)
+        xkey  = self.ctx.xkey(2)
 
         sel   = xs.matmul(xkey.transpose(2,1)).log_softmax(-1)
-        cand  = torch.cat([xz,xs,y],dim=1)
-        lptok = self.vocab(cand).log_softmax(-1)
+        lptok = self.ctx.cand_logp(i,xs)
 
         xq    = (lptok+sel.transpose(2,1)).logsumexp(1,keepdims=True)
         # fs   = torch.cat([fs,xq],dim=1)
-        fs  = torch.scatter(fs,index=(xq*0).long()+i,src=xq,dim=1)
+        fs  = self._put_slot(fs,i,xq)
         # import pdb; pdb.set_trace()
-        xsa = torch.scatter(xsa,index=(xs*0).long()+i,src=xs,dim=1)
+        xsa = self._put_slot(xsa,i,xs)
 
         outer = [zi,x,y,z,fs]
         inner = [i,sel,xz,xsa]
         return outer,inner
 
+    def _step_colour(self,outer,inner):
+        '''
+        _step for all positions idx of one colour at once, see _run_checkerboard
+        '''
+        (zi,x,y,z,fs) = outer
+        (idx,sel,xz,xsa) = inner
 
-    def _loss(self,zi,x,y,z,out='loss'):
-        assert out in 'loss token traj'.split()
+        xz = z[:,idx]
+        xl,xr = self._neighbours(xsa,idx)
+        xs = xl.matmul(self.transition.weight) + xr.matmul(self.transition.weight.transpose(1,0))
+        xs = xs + self.updater(xz)
+        xs = self.norm(xs)
+
+        xkey  = self.ctx.xkey(2)
+        sel   = xs.matmul(xkey.transpose(2,1)).log_softmax(-1)
+        lptok = self.ctx.cand_logp_at(idx,xs)
+
+        xq    = (lptok+sel[:,:,:,None]).logsumexp(2)
+        fs    = fs.index_copy(1,idx,xq)
+        xsa   = xsa.index_copy(1,idx,xs)
+
+        outer = [zi,x,y,z,fs]
+        inner = [idx,sel,xz,xsa]
+        return outer,inner
+
+
+    def _loss(self,zi,x,y,z,out='loss',lengths=None):
+        assert set(self._outs(out)) <= set('loss token traj grad_loss'.split())
 
         outer,inner = self._batch_init(zi,x,y,z)
         ### Uses an explicit RNN to switch between copying z and extract y
-        self.callback_init(outer)
         L = z.size(1)
-        for i in range(L):
-            inner[0]=i
-            outer,inner = self._step(outer,inner) #### do what ever with your hidden state
-            self.callback_step(outer,inner)
-        for i in range(L):
-            inner[0]=L-1-i
-            outer,inner = self._step(outer,inner) #### do what ever with your hidden state
-            self.callback_step(outer,inner)
-        for i in range(L):
-            inner[0]=i
-            outer,inner = self._step(outer,inner) #### do what ever with your hidden state
-            self.callback_step(outer,inner)
-
-        self.callback_end(outer)
+        if self.sweep_schedule=='checkerboard':
+            outer,inner = self._run_checkerboard(outer,inner,L,lengths=lengths)
+        else:
+            outer,inner = self._run_sweeps(outer,inner,[
+                range(L),
+                range(L-1,-1,-1),
+                range(L)],lengths=lengths)
         (zi,x,y,z,lptok) = outer
 
         cent = self.target_energy(lptok,x)
-        loss  = -cent.mean(-1)
+        loss  = -self._token_mean(cent,lengths)
         # if out=='token': return lptok
-        if out=='token': return lptok
-
-        if out=='loss': return loss
-        assert 0
+        return self._pick(out,loss=loss,token=lptok)
 
 # class RefillModelRNNAdditiveDirectMixingWithGate(RefillModelRNNBase):
 #     def __init__(self,
@@ -1367,16 +2031,17 @@ class RefillModelRNNAdditiveDirectMixingWithAttention(RefillModelRNNBase):
         xs = xsa[:,i:i+1]
         ##### adds attention interaction term
         # import pdb; pdb.set_trace()
-        att = self.att_kernel(xs).matmul(xsa.transpose(2,1)).softmax(-1)
+        xsf = self._full(xsa)
+        att = self.ctx.pad_logits(self.att_kernel(xs).matmul(xsf.transpose(2,1))).softmax(-1)
         att = att * (self.att_prob(xs)[:,:,0:1].sigmoid())
-        val = att.matmul(xsa)
+        val = att.matmul(xsf)
         xs  = xs+ (val).matmul(self.att_energy.weight.T)
 
         if i>=1:
             xsl = xsa[:,i-1:i]
             xs = xs + xsl.matmul(self.transition.weight)
         if i+1<=L-1:
-            xsl = xsa[:,i+1:i+2]
+            xsl = self.ctx.right(i,xsa[:,i+1:i+2])
             xs = xs + xsl.matmul(self.transition.weight.transpose(1,0  ))
 
         xs = xs + self.updater(xz)
@@ -1390,51 +2055,37 @@ class RefillModelRNNAdditiveDirectMixingWithAttention(RefillModelRNNBase):
 
         xs = self.norm(xs)
 
-        xkey_static = self.xkey_static.weight[None,:2,:self.embed_dim].repeat((len(z),1,1))
-        xkey_dynamic= self.xkey_dynamic(y)
-        xkey  = torch.cat([xkey_static, xkey_dynamic],dim=1)
+        xkey  = self.ctx.xkey(2)
 
         sel   = xs.matmul(xkey.transpose(2,1)).log_softmax(-1)
-        cand  = torch.cat([xz,xs,y],dim=1)
-        lptok = self.vocab(cand).log_softmax(-1)
+        lptok = self.ctx.cand_logp(i,xs)
 
         xq    = (lptok+sel.transpose(2,1)).logsumexp(1,keepdims=True)
         # fs   = torch.cat([fs,xq],dim=1)
-        fs  = torch.scatter(fs,index=(xq*0).long()+i,src=xq,dim=1)
+        fs  = self._put_slot(fs,i,xq)
         # import pdb; pdb.set_trace()
-        xsa = torch.scatter(xsa,index=(xs*0).long()+i,src=xs,dim=1)
+        xsa = self._put_slot(xsa,i,xs)
 
         outer = [zi,x,y,z,fs]
         inner = [i,sel,xz,xsa]
         return outer,inner
 
 
-    def _loss(self,zi,x,y,z,out='loss'):
-        assert out in 'loss token traj'.split()
+    def _loss(self,zi,x,y,z,out='loss',lengths=None):
+        assert set(self._outs(out)) <= set('loss token traj grad_loss'.split())
 
         outer,inner = self._batch_init(zi,x,y,z)
         ### Uses an explicit RNN to switch between copying z and extract y
-        self.callback_init(outer)
         L = z.size(1)
-        for i in range(L):
-            inner[0]=i
-            outer,inner = self._step(outer,inner) #### do what ever with your hidden state
-            self.callback_step(outer,inner)
-        for i in range(L):
-            inner[0]=L-1-i
-            outer,inner = self._step(outer,inner) #### do what ever with your hidden state
-            self.callback_step(outer,inner)
-
-        self.callback_end(outer)
+        outer,inner = self._run_sweeps(outer,inner,[
+            range(L),
+            range(L-1,-1,-1)],lengths=lengths)
         (zi,x,y,z,lptok) = outer
 
         cent = self.target_energy(lptok,x)
-        loss  = -cent.mean(-1)
+        loss  = -self._token_mean(cent,lengths)
         # if out=='token': return lptok
-        if out=='token': return lptok
-
-        if out=='loss': return loss
-        assert 0
+        return self._pick(out,loss=loss,token=lptok)
 
 
 
@@ -1457,61 +2108,44 @@ class RefillModelRNNAdditiveDirectMixingBidirectionalFixedEmission(RefillModelRN
             xsl = xsa[:,i-1:i]
             xs = xs + xsl.matmul(self.transition.weight)
         if i+1<=L-1:
-            xsl = xsa[:,i+1:i+2]
+            xsl = self.ctx.right(i,xsa[:,i+1:i+2])
             xs = xs + xsl.matmul(self.transition.weight.transpose(1,0  ))
 
         xs = xs + (xz)
         xs = self.norm(xs)
 
-        xkey_static = self.xkey_static.weight[None,:2,:self.embed_dim].repeat((len(z),1,1))
-        xkey_dynamic= self.xkey_dynamic(y)
-        xkey  = torch.cat([xkey_static, xkey_dynamic],dim=1)
+        xkey  = self.ctx.xkey(2)
 
         sel   = xs.matmul(xkey.transpose(2,1)).log_softmax(-1)
-        cand  = torch.cat([xz,xs,y],dim=1)
-        lptok = self.vocab(cand).log_softmax(-1)
+        lptok = self.ctx.cand_logp(i,xs)
 
         xq    = (lptok+sel.transpose(2,1)).logsumexp(1,keepdims=True)
         # fs   = torch.cat([fs,xq],dim=1)
-        fs  = torch.scatter(fs,index=(xq*0).long()+i,src=xq,dim=1)
+        fs  = self._put_slot(fs,i,xq)
         # import pdb; pdb.set_trace()
-        xsa = torch.scatter(xsa,index=(xs*0).long()+i,src=xs,dim=1)
+        xsa = self._put_slot(xsa,i,xs)
 
         outer = [zi,x,y,z,fs]
         inner = [i,sel,xz,xsa]
         return outer,inner
 
 
-    def _loss(self,zi,x,y,z,out='loss'):
-        assert out in 'loss token traj'.split()
+    def _loss(self,zi,x,y,z,out='loss',lengths=None):
+        assert set(self._outs(out)) <= set('loss token traj grad_loss'.split())
 
         outer,inner = self._batch_init(zi,x,y,z)
         ### Uses an explicit RNN to switch between copying z and extract y
-        self.callback_init(outer)
         L = z.size(1)
-        for i in range(L):
-            inner[0]=i
-            outer,inner = self._step(outer,inner) #### do what ever with your hidden state
-            self.callback_step(outer,inner)
-        for i in range(L):
-            inner[0]=L-1-i
-            outer,inner = self._step(outer,inner) #### do what ever with your hidden state
-            self.callback_step(outer,inner)
-        for i in range(L):
-            inner[0]=i
-            outer,inner = self._step(outer,inner) #### do what ever with your hidden state
-            self.callback_step(outer,inner)
-
-        self.callback_end(outer)
+        outer,inner = self._run_sweeps(outer,inner,[
+            range(L),
+            range(L-1,-1,-1),
+            range(L)],lengths=lengths)
         (zi,x,y,z,lptok) = outer
 
         cent = self.target_energy(lptok,x)
-        loss  = -cent.mean(-1)
+        loss  = -self._token_mean(cent,lengths)
         # if out=='token': return lptok
-        if out=='token': return lptok
-
-        if out=='loss': return loss
-        assert 0
+        return self._pick(out,loss=loss,token=lptok)
 
 
 class RefillModelRNNAdditiveSweeping(RefillModelRNNBase):
@@ -1595,59 +2229,42 @@ class RefillModelRNNAdditiveSweeping(RefillModelRNNBase):
             xsl = xsa[:,i-1:i]
             xs = xs + xsl.matmul(self.transition.weight)
         if i+1<=L-1:
-            xsl = xsa[:,i+1:i+2]
+            xsl = self.ctx.right(i,xsa[:,i+1:i+2])
             xs = xs + xsl.matmul(self.transition.weight.transpose(1,0   ))
 
         xs = xs + self.updater(xz)
         xs = self.norm(xs)
 
-        xkey_static = self.xkey_static.weight[None,:2,:self.embed_dim].repeat((len(z),1,1))
-        xkey_dynamic= self.xkey_dynamic(y)
-        xkey  = torch.cat([xkey_static, xkey_dynamic],dim=1)
+        xkey  = self.ctx.xkey(2)
 
         sel   = xs.matmul(xkey.transpose(2,1)).log_softmax(-1)
-        cand  = torch.cat([xz,xs,y],dim=1)
-        lptok = self.vocab(cand).log_softmax(-1)
+        lptok = self.ctx.cand_logp(i,xs)
 
         xq    = (lptok+sel.transpose(2,1)).logsumexp(1,keepdims=True)
-        fs  = torch.scatter(fs,index=(xq*0).long()+i,src=xq,dim=1)
-        xsa = torch.scatter(xsa,index=(xs*0).long()+i,src=xs,dim=1)
+        fs  = self._put_slot(fs,i,xq)
+        xsa = self._put_slot(xsa,i,xs)
 
         outer = [zi,x,y,z,fs]
         inner = [i,sel,xz,xsa]
         return outer,inner
 
 
-    def _loss(self,zi,x,y,z,out='loss'):
-        assert out in 'loss token traj'.split()
+    def _loss(self,zi,x,y,z,out='loss',lengths=None):
+        assert set(self._outs(out)) <= set('loss token traj grad_loss'.split())
 
         outer,inner = self._batch_init(zi,x,y,z)
         ### Uses an explicit RNN to switch between copying z and extract y
-        self.callback_init(outer)
         L = z.size(1)
-        for i in range(L):
-            inner[0]=i
-            outer,inner = self._step(outer,inner) #### do what ever with your hidden state
-            self.callback_step(outer,inner)
-        for i in range(L):
-            inner[0]=L-1-i
-            outer,inner = self._step(outer,inner) #### do what ever with your hidden state
-            self.callback_step(outer,inner)
-        for i in range(L):
-            inner[0]=i
-            outer,inner = self._step(outer,inner) #### do what ever with your hidden state
-            self.callback_step(outer,inner)
-
-        self.callback_end(outer)
+        outer,inner = self._run_sweeps(outer,inner,[
+            range(L),
+            range(L-1,-1,-1),
+            range(L)],lengths=lengths)
         (zi,x,y,z,lptok) = outer
 
         cent = self.target_energy(lptok,x)
-        loss  = -cent.mean(-1)
+        loss  = -self._token_mean(cent,lengths)
         # if out=='token': return lptok
-        if out=='token': return lptok
-
-        if out=='loss': return loss
-        assert 0
+        return self._pick(out,loss=loss,token=lptok)
 
 
 class RefillModelRNNAdditiveSweepingWithResidual(RefillModelRNNBase):
@@ -1731,59 +2348,42 @@ class RefillModelRNNAdditiveSweepingWithResidual(RefillModelRNNBase):
             xsl = xsa[:,i-1:i]
             xs = xs + xsl.matmul(self.transition.weight)
         if i+1<=L-1:
-            xsl = xsa[:,i+1:i+2]
+            xsl = self.ctx.right(i,xsa[:,i+1:i+2])
             xs = xs + xsl.matmul(self.transition.weight.transpose(1,0   ))
 
         xs = xs + self.updater(xz)
         xs = self.norm(xs)
 
-        xkey_static = self.xkey_static.weight[None,:2,:self.embed_dim].repeat((len(z),1,1))
-        xkey_dynamic= self.xkey_dynamic(y)
-        xkey  = torch.cat([xkey_static, xkey_dynamic],dim=1)
+        xkey  = self.ctx.xkey(2)
 
         sel   = xs.matmul(xkey.transpose(2,1)).log_softmax(-1)
-        cand  = torch.cat([xz,xs,y],dim=1)
-        lptok = self.vocab(cand).log_softmax(-1)
+        lptok = self.ctx.cand_logp(i,xs)
 
         xq    = (lptok+sel.transpose(2,1)).logsumexp(1,keepdims=True)
-        fs  = torch.scatter(fs,index=(xq*0).long()+i,src=xq,dim=1)
-        xsa = torch.scatter(xsa,index=(xs*0).long()+i,src=xs,dim=1)
+        fs  = self._put_slot(fs,i,xq)
+        xsa = self._put_slot(xsa,i,xs)
 
         outer = [zi,x,y,z,fs]
         inner = [i,sel,xz,xsa]
         return outer,inner
 
 
-    def _loss(self,zi,x,y,z,out='loss'):
-        assert out in 'loss token traj'.split()
+    def _loss(self,zi,x,y,z,out='loss',lengths=None):
+        assert set(self._outs(out)) <= set('loss token traj grad_loss'.split())
 
         outer,inner = self._batch_init(zi,x,y,z)
         ### Uses an explicit RNN to switch between copying z and extract y
-        self.callback_init(outer)
         L = z.size(1)
-        for i in range(L):
-            inner[0]=i
-            outer,inner = self._step(outer,inner) #### do what ever with your hidden state
-            self.callback_step(outer,inner)
-        for i in range(L):
-            inner[0]=L-1-i
-            outer,inner = self._step(outer,inner) #### do what ever with your hidden state
-            self.callback_step(outer,inner)
-        for i in range(L):
-            inner[0]=i
-            outer,inner = self._step(outer,inner) #### do what ever with your hidden state
-            self.callback_step(outer,inner)
-
-        self.callback_end(outer)
+        outer,inner = self._run_sweeps(outer,inner,[
+            range(L),
+            range(L-1,-1,-1),
+            range(L)],lengths=lengths)
         (zi,x,y,z,lptok) = outer
 
         cent = self.target_energy(lptok,x)
-        loss  = -cent.mean(-1)
+        loss  = -self._token_mean(cent,lengths)
         # if out=='token': return lptok
-        if out=='token': return lptok
-
-        if out=='loss': return loss
-        assert 0
+        return self._pick(out,loss=loss,token=lptok)
 
 class RefillModelMixtureRNNSweepingOldEmission(RefillModelRNNBase):
     '''
@@ -1970,7 +2570,7 @@ class RefillModelMixtureRNNSweepingOldEmission(RefillModelRNNBase):
             xl = xlr[:,i-1:i]
             xss = xss + xl.matmul(self.Wr.weight.T)
         if i+1<=L-1:
-            xr = xlr[:,i+1:i+2]
+            xr = self.ctx.right(i,xlr[:,i+1:i+2])
             xss = xss + xr.matmul(self.Wr.weight)
         xss = self.norm(xss)
 
@@ -1980,7 +2580,7 @@ class RefillModelMixtureRNNSweepingOldEmission(RefillModelRNNBase):
             xl = xlr[:,i-1:i]
             xe  = xe  + (xss * xl.matmul(self.Wr.weight.T)).mean(-1)
         if i+1<=L-1:
-            xr = xlr[:,i+1:i+2]
+            xr = self.ctx.right(i,xlr[:,i+1:i+2])
             xe  = xe  + (xss * xr.matmul(self.Wr.weight)).mean(-1)
         xp = xe.softmax(-1)[:,:,:,None]  ### select the best node
         # import pdb; pdb.set_trace()
@@ -1989,12 +2589,12 @@ class RefillModelMixtureRNNSweepingOldEmission(RefillModelRNNBase):
             ## copy from left or new vector
             val = xlr[:,i-1:i] if i>=1 else 0.
             val  = xp*xss + (1-xp) * val
-            xlr  = torch.scatter(xlr,index=(val*0).long()+i,src=val,dim=1)
+            xlr  = self._put_slot(xlr,i,val)
         elif lr==-1:
             ### copy from right or new vector
-            val = xlr[:,i+1:i+2] if i+1<=L-1 else 0.
+            val = self.ctx.right(i,xlr[:,i+1:i+2]) if i+1<=L-1 else 0.
             val  = xp*xss + (1-xp) * val
-            xlr  = torch.scatter(xlr,index=(val*0).long()+i,src=val,dim=1)
+            xlr  = self._put_slot(xlr,i,val)
         else:
             raise Exception(f'Unknown lr={lr}')
 
@@ -2003,51 +2603,74 @@ class RefillModelMixtureRNNSweepingOldEmission(RefillModelRNNBase):
 
         ### old emission function to populate (fs)
         if 1:
-            xkey_static = self.xkey_static.weight[None,:2,:self.embed_dim].repeat((len(z),1,1))
-            xkey_dynamic= self.xkey_dynamic(y)
-            xkey  = torch.cat([xkey_static, xkey_dynamic],dim=1)
+            xkey  = self.ctx.xkey(2)
 
             xs = self.norm((xss*xp).sum(2))
 
             sel   = xs.matmul(xkey.transpose(2,1)).log_softmax(-1)
-            cand  = torch.cat([xz[:,0],xs,y],dim=1)
-            lptok = self.vocab(cand).log_softmax(-1)
+            lptok = self.ctx.cand_logp(i,xs)
 
             xq    = (lptok+sel.transpose(2,1)).logsumexp(1,keepdims=True)
-            fs    = torch.scatter(fs,index=(xq*0).long()+i,src=xq,dim=1)
+            fs    = self._put_slot(fs,i,xq)
 
         outer = [zi,x,y,z,fs]
         # inner = d
         inner = [i,xp.reshape((B,1,K)).log(),xlr,xsa]
         return outer,inner
 
+    def _step_colour(self,outer,inner):
+        '''
+        _step for all positions idx of one colour at once, see _run_checkerboard
+        :type xss: shape of (B, P, K, E)
+        '''
+        (zi,x,  y,  z, fs) = outer
+        ((idx,lr), sel,  xlr,   xsa) = inner
+
+        xz = z[:,idx,None]
+        xl,xr = self._neighbours(xlr,idx)
+        xzt = xz.matmul(self.We.weight.T)
+        xlt = xl.matmul(self.Wr.weight.T)
+        xrt = xr.matmul(self.Wr.weight)
+        xss = self.norm(xzt + xlt + xrt)
+        xe  = (xss*xzt).mean(-1) + (xss*xlt).mean(-1) + (xss*xrt).mean(-1)
+        xp  = xe.softmax(-1)[:,:,:,None]
+
+        #### propagate the images, copying from the side of the sweep
+        val = xl if lr==1 else xr
+        val = xp*xss + (1-xp) * val
+        xlr = xlr.index_copy(1,idx,val)
+
+        ### old emission function to populate (fs)
+        xkey  = self.ctx.xkey(2)
+        xs    = self.norm((xss*xp).sum(2))
+        sel   = xs.matmul(xkey.transpose(2,1)).log_softmax(-1)
+        lptok = self.ctx.cand_logp_at(idx,xs)
+        xq    = (lptok+sel[:,:,:,None]).logsumexp(2)
+        fs    = fs.index_copy(1,idx,xq)
+
+        outer = [zi,x,y,z,fs]
+        inner = [(idx,lr),xp[:,:,:,0].log(),xlr,xsa]
+        return outer,inner
+
 
-    def _loss(self,zi,x,y,z,out='loss'):
-        assert out in 'loss token traj'.split()
+    def _loss(self,zi,x,y,z,out='loss',lengths=None):
+        assert set(self._outs(out)) <= set('loss token traj grad_loss'.split())
 
         outer,inner = self._batch_init(zi,x,y,z)
         ### Uses an explicit RNN to switch between copying z and extract y
-        self.callback_init(outer)
         L = z.size(1)
-        for i in range(L):
-            inner[0]=(i,1)
-            outer,inner = self._step(outer,inner) #### do what ever with your hidden state
-            self.callback_step(outer,inner)
-        for i in range(L):
-            inner[0]=(L-1-i,-1)
-            outer,inner = self._step(outer,inner) #### do what ever with your hidden state
-            self.callback_step(outer,inner)
-
-        self.callback_end(outer)
+        if self.sweep_schedule=='checkerboard':
+            outer,inner = self._run_checkerboard(outer,inner,L,lrs=(1,-1),lengths=lengths)
+        else:
+            outer,inner = self._run_sweeps(outer,inner,[
+                [(i,1) for i in range(L)],
+                [(i,-1) for i in range(L-1,-1,-1)]],inner_slots=(2,),lengths=lengths)
         (zi,x,y,z,lptok) = outer
 
         cent = self.target_energy(lptok,x)
-        loss  = -cent.mean(-1)
+        loss  = -self._token_mean(cent,lengths)
         # if out=='token': return lptok
-        if out=='token': return lptok
-
-        if out=='loss': return loss
-        assert 0
+        return self._pick(out,loss=loss,token=lptok)
 
 
 class RefillModelMixtureRNNSweepingOldEmissionDifferentTransition(RefillModelRNNBase):
@@ -2092,7 +2715,9 @@ class RefillModelMixtureRNNSweepingOldEmissionDifferentTransition(RefillModelRNN
         #### share embed usually works
         # self.vocab      = nn.Linear(embed_dim,graph_dim,).to(self.device)
         self.embed        = nn.Embedding(graph_dim,embed_dim,).to(self.device)
-        self.embed_extra  = nn.Embedding(10,embed_dim,).to(self.device)
+        ### one row per component; for K<=10 the shape stays that of
+        ### the existing checkpoints
+        self.embed_extra  = nn.Embedding(max(10,mixture_count),embed_dim,).to(self.device)
         self.n_step       = min_len
         self.xkey_static  = nn.Linear(embed_dim, 2).to(self.device)
         self.xkey_dynamic = nn.Linear(embed_dim, embed_dim).to(self.device)
@@ -2105,6 +2730,21 @@ class RefillModelMixtureRNNSweepingOldEmissionDifferentTransition(RefillModelRNN
 
 
 
+    ### set False for the broadcast-and-sum reference of _trans_wr
+    bmm_transitions = True
+    def _trans_wr(self,x,Wr):
+        '''
+        Per-component transition x[:,:,k] @ Wr[k], as one bmm over K
+        instead of a (B,P,K,E,E) broadcast product
+        :type x:  shape of (B, P, K, E)
+        :type Wr: shape of (K, E, E)
+        '''
+        if not self.bmm_transitions:
+            return (x[:,:,:,:,None] * Wr[None,None]).sum(-2)
+        B,P,K,E = x.shape
+        x = torch.bmm(x.reshape((B*P,K,E)).transpose(0,1),Wr)
+        return x.transpose(0,1).reshape((B,P,K,E))
+
     def _batch_init(self,zi,x,y,z):
         '''
         :type zi: shape of (B,)
@@ -2232,33 +2872,29 @@ class RefillModelMixtureRNNSweepingOldEmissionDifferentTransition(RefillModelRNN
         # import pdb; pdb.set_trace()
 
 
+        ### each transition product is computed once, for both xss and xe
+        xzt = xz.matmul(self.We.weight.T)
+        xlt = self._trans_wr(xlr[:,i-1:i],Wr) if i>=1 else None
+        xrt = self._trans_wr(self.ctx.right(i,xlr[:,i+1:i+2]),Wr.transpose(2,1)) if i+1<=L-1 else None
+
         xss = 0.
         ### always have Z
-        xss = xss + xz.matmul(self.We.weight.T)
-        def trans_wr(xr,Wr):
-            x = xr[:,:,:,:,None] * Wr[None,None]
-            x = x.sum(-2)
-            return x
-
-        if i>=1:
-            xl = xlr[:,i-1:i]
-            xss = xss + trans_wr(xl,Wr)
+        xss = xss + xzt
+        if xlt is not None:
+            xss = xss + xlt
             # xl.matmul(self.Wr.weight.T)
-        if i+1<=L-1:
-            xr = xlr[:,i+1:i+2]
-            xss = xss +  trans_wr(xr,Wr.transpose(2,1))
+        if xrt is not None:
+            xss = xss + xrt
             # xr.matmul(self.Wr.weight)
         xss = self.norm(xss)
 
         xe = 0
-        xe = xe + (xss * xz.matmul(self.We.weight.T)).mean(-1)
-        if i>=1 and 1==1:
-            xl = xlr[:,i-1:i]
-            xe  = xe  + (xss * trans_wr(xl,Wr)).mean(-1)
+        xe = xe + (xss * xzt).mean(-1)
+        if xlt is not None:
+            xe  = xe  + (xss * xlt).mean(-1)
             # xe  = xe  + (xss * xl.matmul(self.Wr.weight.T)).mean(-1)
-        if i+1<=L-1 and -1==-1:
-            xr = xlr[:,i+1:i+2]
-            xe  = xe  + (xss *  trans_wr(xr,Wr.transpose(2,1))).mean(-1)
+        if xrt is not None:
+            xe  = xe  + (xss * xrt).mean(-1)
 
         xp = xe.softmax(-1)[:,:,:,None]  ### select the best node
         # import pdb; pdb.set_trace()
@@ -2267,12 +2903,12 @@ class RefillModelMixtureRNNSweepingOldEmissionDifferentTransition(RefillModelRNN
             ## copy from left or new vector
             val = xlr[:,i-1:i] if i>=1 else 0.
             val  = xp*xss + (1-xp) * val
-            xlr  = torch.scatter(xlr,index=(val*0).long()+i,src=val,dim=1)
+            xlr  = self._put_slot(xlr,i,val)
         elif lr==-1:
             ### copy from right or new vector
-            val = xlr[:,i+1:i+2] if i+1<=L-1 else 0.
+            val = self.ctx.right(i,xlr[:,i+1:i+2]) if i+1<=L-1 else 0.
             val  = xp*xss + (1-xp) * val
-            xlr  = torch.scatter(xlr,index=(val*0).long()+i,src=val,dim=1)
+            xlr  = self._put_slot(xlr,i,val)
         else:
             raise Exception(f'Unknown lr={lr}')
 
@@ -2281,24 +2917,19 @@ class RefillModelMixtureRNNSweepingOldEmissionDifferentTransition(RefillModelRNN
 
         ### old emission function to populate (fs)
         if 0:
-            xkey_static = self.xkey_static.weight[None,:2,:self.embed_dim].repeat((len(z),1,1))
-            xkey_dynamic= self.xkey_dynamic(y)
-            xkey  = torch.cat([xkey_static, xkey_dynamic],dim=1)
+            xkey  = self.ctx.xkey(2)
 
             xs = self.norm((xss*xp).sum(2))
 
             sel   = xs.matmul(xkey.transpose(2,1)).log_softmax(-1)
-            cand  = torch.cat([xz[:,0],xs,y],dim=1)
-            lptok = self.vocab(cand).log_softmax(-1)
+            lptok = self.ctx.cand_logp(i,xs)
 
             xq    = (lptok+sel.transpose(2,1)).logsumexp(1,keepdims=True)
-            fs    = torch.scatter(fs,index=(xq*0).long()+i,src=xq,dim=1)
+            fs    = self._put_slot(fs,i,xq)
 
         if 1:
 
-            xkey_static = self.xkey_static.weight[None,:1,:self.embed_dim].repeat((len(z),1,1))
-            xkey_dynamic= self.xkey_dynamic(y)
-            xkey  = torch.cat([xkey_static, xkey_dynamic],dim=1)
+            xkey  = self.ctx.xkey(1)
 
             #### all xss are equally possible to be the vector, thus should consider all
             #### consider all possiblilities equally. expand the nodes then compute lptok
@@ -2313,11 +2944,10 @@ class RefillModelMixtureRNNSweepingOldEmissionDifferentTransition(RefillModelRNN
             # import pdb; pdb.set_trace()
             # xs = self.norm((xss*xp).sum(2))
             # sel   = xs.matmul(xkey.transpose(2,1)).log_softmax(-1)
-            cand  = torch.cat([xz[:,0],y],dim=1)
-            lptok = self.vocab(cand).log_softmax(-1)
+            lptok = self.ctx.cand_logp(i,None)
 
             xq    = (lptok+sel.transpose(2,1)).logsumexp(1,keepdims=True)
-            fs    = torch.scatter(fs,index=(xq*0).long()+i,src=xq,dim=1)
+            fs    = self._put_slot(fs,i,xq)
 
 
 
@@ -2325,33 +2955,62 @@ class RefillModelMixtureRNNSweepingOldEmissionDifferentTransition(RefillModelRNN
         inner = [i,xp.reshape((B,1,K)).log(),xlr,xsa]
         return outer,inner
 
+    def _step_colour(self,outer,inner):
+        '''
+        _step for all positions idx of one colour at once, see _run_checkerboard
+        :type xss: shape of (B, P, K, E)
+        '''
+        (zi,x,  y,  z, fs) = outer
+        ((idx,lr), sel,  xlr,   xsa) = inner
+        K  = self.K
+        E  = self.embed_dim
+        Wr = self.Wr.weight.reshape((K,E,E))
 
-    def _loss(self,zi,x,y,z,out='loss'):
-        assert out in 'loss token traj'.split()
+        xz = z[:,idx,None]
+        xl,xr = self._neighbours(xlr,idx)
+        xzt = xz.matmul(self.We.weight.T)
+        xlt = self._trans_wr(xl,Wr)
+        xrt = self._trans_wr(xr,Wr.transpose(2,1))
+        xss = self.norm(xzt + xlt + xrt)
+        xe  = (xss*xzt).mean(-1) + (xss*xlt).mean(-1) + (xss*xrt).mean(-1)
+        xp  = xe.softmax(-1)[:,:,:,None]
+
+        #### propagate the images, copying from the side of the sweep
+        val = xl if lr==1 else xr
+        val = xp*xss + (1-xp) * val
+        xlr = xlr.index_copy(1,idx,val)
+
+        #### emission mixed over all K nodes
+        xkey  = self.ctx.xkey(1)
+        sel   = xss.matmul(xkey[:,None].transpose(3,2)).log_softmax(-1)
+        sel   = (sel + xp.log()).logsumexp(2)
+        lptok = self.ctx.cand_logp_at(idx,None)
+        xq    = (lptok+sel[:,:,:,None]).logsumexp(2)
+        fs    = fs.index_copy(1,idx,xq)
+
+        outer = [zi,x,y,z,fs]
+        inner = [(idx,lr),xp[:,:,:,0].log(),xlr,xsa]
+        return outer,inner
+
+
+    def _loss(self,zi,x,y,z,out='loss',lengths=None):
+        assert set(self._outs(out)) <= set('loss token traj grad_loss'.split())
 
         outer,inner = self._batch_init(zi,x,y,z)
         ### Uses an explicit RNN to switch between copying z and extract y
-        self.callback_init(outer)
         L = z.size(1)
-        for i in range(L):
-            inner[0]=(i,1)
-            outer,inner = self._step(outer,inner) #### do what ever with your hidden state
-            self.callback_step(outer,inner)
-        for i in range(L):
-            inner[0]=(L-1-i,-1)
-            outer,inner = self._step(outer,inner) #### do what ever with your hidden state
-            self.callback_step(outer,inner)
-
-        self.callback_end(outer)
+        if self.sweep_schedule=='checkerboard':
+            outer,inner = self._run_checkerboard(outer,inner,L,lrs=(1,-1),lengths=lengths)
+        else:
+            outer,inner = self._run_sweeps(outer,inner,[
+                [(i,1) for i in range(L)],
+                [(i,-1) for i in range(L-1,-1,-1)]],inner_slots=(2,),lengths=lengths)
         (zi,x,y,z,lptok) = outer
 
         cent = self.target_energy(lptok,x)
-        loss  = -cent.mean(-1)
+        loss  = -self._token_mean(cent,lengths)
         # if out=='token': return lptok
-        if out=='token': return lptok
-
-        if out=='loss': return loss
-        assert 0
+        return self._pick(out,loss=loss,token=lptok)
 
 
 class RefillModelMixtureRNNSweepingOldEmission2(RefillModelMixtureRNNSweepingOldEmission):
@@ -2538,7 +3197,7 @@ class RefillModelMixtureRNNSweepingNewEmission(RefillModelRNNBase):
             xl = xlr[:,i-1:i]
             xss = xss + xl.matmul(self.Wr.weight.T)
         if i+1<=L-1:
-            xr = xlr[:,i+1:i+2]
+            xr = self.ctx.right(i,xlr[:,i+1:i+2])
             xss = xss + xr.matmul(self.Wr.weight)
         xss = self.norm(xss)
 
@@ -2548,7 +3207,7 @@ class RefillModelMixtureRNNSweepingNewEmission(RefillModelRNNBase):
             xl = xlr[:,i-1:i]
             xe  = xe  + (xss * xl.matmul(self.Wr.weight.T)).mean(-1)
         if i+1<=L-1:
-            xr = xlr[:,i+1:i+2]
+            xr = self.ctx.right(i,xlr[:,i+1:i+2])
             xe  = xe  + (xss * xr.matmul(self.Wr.weight)).mean(-1)
         xp = xe.softmax(-1)[:,:,:,None]  ### select the best node
 
@@ -2558,13 +3217,13 @@ class RefillModelMixtureRNNSweepingNewEmission(RefillModelRNNBase):
             val  = xlr[:,i-1:i] if i>=1 else 0.
             val  = xp*xss + (1-xp) * val
             val  = self.norm(val)
-            xlr  = torch.scatter(xlr,index=(val*0).long()+i,src=val,dim=1)
+            xlr  = self._put_slot(xlr,i,val)
         elif lr==-1:
             ### copy from right or new vector
-            val  = xlr[:,i+1:i+2] if i+1<=L-1 else 0.
+            val  = self.ctx.right(i,xlr[:,i+1:i+2]) if i+1<=L-1 else 0.
             val  = xp*xss + (1-xp) * val
             val  = self.norm(val)
-            xlr  = torch.scatter(xlr,index=(val*0).long()+i,src=val,dim=1)
+            xlr  = self._put_slot(xlr,i,val)
         else:
             raise Exception(f'Unknown lr={lr}')
 
@@ -2582,7 +3241,7 @@ class RefillModelMixtureRNNSweepingNewEmission(RefillModelRNNBase):
             lptok = self.vocab(cand).log_softmax(-1)
 
             xq    = (lptok+sel.transpose(2,1)).logsumexp(1,keepdims=True)
-            fs    = torch.scatter(fs,index=(xq*0).long()+i,src=xq,dim=1)
+            fs    = self._put_slot(fs,i,xq)
 
         if 0:
             # xkey_static = self.xkey_static.weight[None,:2,:self.embed_dim].repeat((len(z),1,1))
@@ -2600,7 +3259,7 @@ class RefillModelMixtureRNNSweepingNewEmission(RefillModelRNNBase):
             lptok = self.vocab(cand).log_softmax(-1)
 
             xq    = (lptok+sel.transpose(2,1)).logsumexp(1,keepdims=True)
-            fs    = torch.scatter(fs,index=(xq*0).long()+i,src=xq,dim=1)
+            fs    = self._put_slot(fs,i,xq)
 
         '''
         Epoch: 45
@@ -2613,33 +3272,59 @@ class RefillModelMixtureRNNSweepingNewEmission(RefillModelRNNBase):
         inner = [(i,lr),sel,xlr,xsa]
         return outer,inner
 
+    def _step_colour(self,outer,inner):
+        '''
+        _step for all positions idx of one colour at once, see _run_checkerboard
+        :type xss: shape of (B, P, K, E)
+        '''
+        (zi,x,  y,  z, fs) = outer
+        ((idx,lr), sel,  xlr,   xsa) = inner
+
+        xz = z[:,idx,None]
+        xl,xr = self._neighbours(xlr,idx)
+        xzt = xz.matmul(self.We.weight.T)
+        xlt = xl.matmul(self.Wr.weight.T)
+        xrt = xr.matmul(self.Wr.weight)
+        xss = self.norm(xzt + xlt + xrt)
+        xe  = (xss*xzt).mean(-1) + (xss*xlt).mean(-1) + (xss*xrt).mean(-1)
+        xp  = xe.softmax(-1)[:,:,:,None]
+
+        #### propagate the images, copying from the side of the sweep
+        val = xl if lr==1 else xr
+        val = self.norm(xp*xss + (1-xp) * val)
+        xlr = xlr.index_copy(1,idx,val)
+
+        ### new emission function to populate (fs)
+        xs    = self.norm((xss*xp).sum(2))
+        cand  = torch.stack([xz[:,:,0],xs],dim=2)
+        sel   = self.xkey_dynamic(cand)[:,:,:,0].log_softmax(-1)
+        lptok = self.vocab(cand).log_softmax(-1)
+        xq    = (lptok+sel[:,:,:,None]).logsumexp(2)
+        fs    = fs.index_copy(1,idx,xq)
 
-    def _loss(self,zi,x,y,z,out='loss'):
-        assert out in 'loss token traj'.split()
+        outer = [zi,x,y,z,fs]
+        inner = [(idx,lr),sel,xlr,xsa]
+        return outer,inner
+
+
+    def _loss(self,zi,x,y,z,out='loss',lengths=None):
+        assert set(self._outs(out)) <= set('loss token traj grad_loss'.split())
 
         outer,inner = self._batch_init(zi,x,y,z)
         ### Uses an explicit RNN to switch between copying z and extract y
-        self.callback_init(outer)
         L = z.size(1)
-        for i in range(L):
-            inner[0]=(i,1)
-            outer,inner = self._step(outer,inner) #### do what ever with your hidden state
-            self.callback_step(outer,inner)
-        for i in range(L):
-            inner[0]=(L-1-i,-1)
-            outer,inner = self._step(outer,inner) #### do what ever with your hidden state
-            self.callback_step(outer,inner)
-
-        self.callback_end(outer)
+        if self.sweep_schedule=='checkerboard':
+            outer,inner = self._run_checkerboard(outer,inner,L,lrs=(1,-1),lengths=lengths)
+        else:
+            outer,inner = self._run_sweeps(outer,inner,[
+                [(i,1) for i in range(L)],
+                [(i,-1) for i in range(L-1,-1,-1)]],inner_slots=(2,),lengths=lengths)
         (zi,x,y,z,lptok) = outer
 
         cent = self.target_energy(lptok,x)
-        loss  = -cent.mean(-1)
+        loss  = -self._token_mean(cent,lengths)
         # if out=='token': return lptok
-        if out=='token': return lptok
-
-        if out=='loss': return loss
-        assert 0
+        return self._pick(out,loss=loss,token=lptok)
 
 
 class RefillModelRNNAttention(RefillModelRNNBase):
@@ -2742,7 +3427,7 @@ class RefillModelRNNAttention(RefillModelRNNBase):
         # print(sel.shape)
         # import pdb; pdb.set_trace()
         ### maybe make query vector a function of state?
-        cand = self.selector_q.weight[None].matmul(self.selector_k(y).transpose(2,1)).softmax(-1).matmul(y)
+        cand = self.ctx.cand()
         # cand = self.selector_q(xs).reshape((len(xs),-1,self.embed_dim))
         # cand = self.norm(cand).matmul(self.selector_k(y).transpose(2,1)).softmax(-1).matmul(y)
         # cand = torch.cat([xz,cand[:,1:]],dim=1)
@@ -2750,7 +3435,7 @@ class RefillModelRNNAttention(RefillModelRNNBase):
         xq   = sel.matmul(cand)
         xs   = xs + self.updater(xq)
 
-        fs   = torch.cat([fs,xq],dim=1)
+        fs   = self._append_step(fs,xq)
         outer = [zi,x,y,z,fs]
         inner = [i,sel,xz,xs]
         return outer,inner
@@ -2848,7 +3533,7 @@ class RefillModelNGRAM(RefillModelRNNBase):
         sel = self.selector(xs.reshape((L,1,-1))).softmax(-1)
         # import pdb; pdb.set_trace()
         ### maybe make query vector a function of state?
-        cand = self.selector_q.weight[None].matmul(self.selector_k(y).transpose(2,1)).softmax(-1).matmul(y)
+        cand = self.ctx.cand()
         # cand = self.selector_q(xs.reshape((L,1,-1))).reshape((len(xs),-1,self.embed_dim))
         # cand = cand.matmul(self.selector_k(y).transpose(2,1)).softmax(-1).matmul(y)
         # cand = torch.cat([xz,cand[:,1:]],dim=1)
@@ -2856,10 +3541,39 @@ class RefillModelNGRAM(RefillModelRNNBase):
         xq   = sel.matmul(cand)
         # xs   = xs + self.updater(xq)
 
-        fs   = torch.cat([fs,xq],dim=1)
+        fs   = self._append_step(fs,xq)
         outer = [zi,x,y,z,fs]
         inner = [i,sel,xz,xs]
         return outer,inner
+    def _forward_parallel(self,outer,inner):
+        '''
+        _step for all positions at once. The step drops the newest slot
+        before appending updater(z_i), so slots [:-1] only ever see
+        transition() of the initial state and do not depend on the input.
+        They are identical across the batch, since _batch_init starts
+        from zeros, and are advanced on the first row only. transition()
+        is affine, so on [a,1] it is one (E+1,E+1) matrix and its L
+        iterates come from markov_powers() in O(log L) matmuls.
+        '''
+        (zi,x,y,z,fs) = outer
+        B,L = z.size(0),z.size(1)
+        W,bias = self.transition.weight,self.transition.bias
+        E  = W.size(0)
+        M  = torch.cat([torch.cat([W.T,W.new_zeros((E,1))],dim=1),torch.cat([bias,bias.new_ones(1)])[None]],dim=0)
+        a0 = inner[3][0,:-1]
+        a0 = torch.cat([a0,a0.new_ones((len(a0),1))],dim=-1)[:,None]
+        ### (k-1,L,E): slot j after 1..L transitions
+        xa = markov_powers(a0.matmul(M),M,L)[...,:E]
+        a  = xa[None,:,-1]
+        xa = xa.transpose(0,1).reshape((1,L,-1)).expand((B,L,-1))
+        xu = self.updater(z)
+        sel  = self.selector(torch.cat([xa,xu],dim=-1)).softmax(-1)
+        ### candidates are [z_i, cand[:,1:]]
+        fs   = sel[:,:,0:1]*z + sel[:,:,1:].matmul(self.ctx.cand()[:,1:])
+        outer = [zi,x,y,z,fs]
+        inner = [L-1,sel[:,-1:],z[:,-1:],torch.cat([a.expand((B,)+a.shape[1:]),xu[:,-1:]],dim=1)]
+        return outer,inner
+
 
 class RefillModelRNNGRU(RefillModelRNNBase):
     def __init__(self,
@@ -2959,11 +3673,11 @@ class RefillModelRNNGRU(RefillModelRNNBase):
 
         sel = self.selector(xs).softmax(-1)
         ### maybe make query vector a function of state?
-        cand = self.selector_q.weight[None].matmul(self.selector_k(y).transpose(2,1)).softmax(-1).matmul(y)
+        cand = self.ctx.cand()
         # cand = self.selector_q(xs).reshape((len(xs),-1,self.embed_dim)).matmul(self.selector_k(y).transpose(2,1)).softmax(-1).matmul(y)
         cand = torch.cat([xz,cand[:,1:]],dim=1)
         xq   = sel.matmul(cand)
-        fs   = torch.cat([fs,xq],dim=1)
+        fs   = self._append_step(fs,xq)
         outer = [zi,x,y,z,fs]
         inner = [i,sel,xz,xs]
         return outer,inner
@@ -3014,7 +3728,7 @@ class RefillModelCopy(nn.Module):
         yp = torch.gather(lptok,index=yt[:,:,None],dim=-1)[:,:,0]
         return yp
 
-    def loss(self,zi,x,y,z):
+    def loss(self,zi,x,y,z,lengths=None):
         ### state init
         z = self.embed(z)
         y = self.embed(y)
@@ -3030,11 +3744,16 @@ class RefillModelCopy(nn.Module):
             # import pdb; pdb.set_trace()
         # import pdb; pdb.set_trace()
         ### return NLL
-        return -cent.mean(-1)
+        return -RefillModelRNNBase._token_mean(cent,lengths)
 
 
         # return ll
     grad_loss = loss
+    def forward_all(self,zi,x,y,z,outputs=('loss','grad_loss'),lengths=None):
+        ### every position only reads itself and the ones before it,
+        ### so padding only needs leaving out of the mean
+        loss = self.loss(zi,x,y,z,lengths)
+        return {k:dict(loss=loss,grad_loss=loss)[k] for k in outputs}
     def corrupt(self,zi,y):
         # self.sigma = 1.5
         # self.sigma = 1.0
@@ -3082,7 +3801,7 @@ class RefillModelCopyWithRandomFill(nn.Module):
         yp = torch.gather(lptok,index=yt[:,:,None],dim=-1)[:,:,0]
         return yp
 
-    def loss(self,zi,x,y,z,):
+    def loss(self,zi,x,y,z,lengths=None):
         ### state init
         fs = torch.tensor([],requires_grad=True).to(self.device)
         # import pdb; pdb.set_trace()
@@ -3099,11 +3818,16 @@ class RefillModelCopyWithRandomFill(nn.Module):
             # import pdb; pdb.set_trace()
         # import pdb; pdb.set_trace()
         ### return NLL
-        return -cent.mean(-1)
+        return -RefillModelRNNBase._token_mean(cent,lengths)
 
 
         # return ll
     grad_loss = loss
+    def forward_all(self,zi,x,y,z,outputs=('loss','grad_loss'),lengths=None):
+        ### every position only reads itself and the ones before it,
+        ### so padding only needs leaving out of the mean
+        loss = self.loss(zi,x,y,z,lengths)
+        return {k:dict(loss=loss,grad_loss=loss)[k] for k in outputs}
     def corrupt(self,zi,y):
         # self.sigma = 1.5
         # self.sigma = 1.0
@@ -3164,7 +3888,7 @@ class RefillModelOld(nn.Module):
         yp = torch.gather(lptok,index=yt[:,:,None],dim=-1)[:,:,0]
         return yp
 
-    def loss(self,zi,x,y,z):
+    def loss(self,zi,x,y,z,lengths=None):
         ### state init
         z = self.embed(z)
         y = self.embed(y)
@@ -3202,11 +3926,16 @@ class RefillModelOld(nn.Module):
             # import pdb; pdb.set_trace()
         # import pdb; pdb.set_trace()
         ### return NLL
-        return -cent.mean(-1)
+        return -RefillModelRNNBase._token_mean(cent,lengths)
 
 
         # return ll
     grad_loss = loss
+    def forward_all(self,zi,x,y,z,outputs=('loss','grad_loss'),lengths=None):
+        ### every position only reads itself and the ones before it,
+        ### so padding only needs leaving out of the mean
+        loss = self.loss(zi,x,y,z,lengths)
+        return {k:dict(loss=loss,grad_loss=loss)[k] for k in outputs}
     def corrupt(self,zi,y):
         # self.sigma = 1.5
         # self.sigma = 1.0
@@ -5,6 +5,7 @@ import torch.nn.functional as F
 import torch.optim
 
 from markov_lm.Dataset.translation_dataset import EnglishToGermanDataset
+from markov_lm.Dataset.translation_dataset import batch_dataloader
 
 import os,sys
 
@@ -88,8 +89,11 @@ def init_conf(CUDA):
     conf.batch_size = 60
     conf.tsi_max = 10
 
-    conf.dataset = dataset = EnglishToGermanDataset(CUDA=CUDA)
-    conf.dataloader = torch.utils.data.DataLoader(dataset, batch_size=conf.batch_size, shuffle=True)
+    ### --var_len: sentences at their true length, batched by length and
+    ### with the padding left out of the loss
+    conf.var_len = '--var_len' in sys.argv
+    conf.dataset = dataset = EnglishToGermanDataset(CUDA=CUDA,var_len=conf.var_len,languages=("english",))
+    conf.dataloader = batch_dataloader(dataset, batch_size=conf.batch_size, shuffle=True, bucket=conf.var_len)
     # dataloader_test = torch.utils.data.DataLoader(dataset, batch_size=conf.batch_size, shuffle=True)
     # conf.model = model = ExtractionAndMarkovTemplateMatching(graph_dim = dataset.english_vocab_len,mixture_count=conf.mixture_count,state_count=conf.state_count,embed_dim=conf.embed_dim,device=conf.device)
     conf.model = model = ExtractionAndCNNTemplateMatching(graph_dim = dataset.english_vocab_len,mixture_count=conf.mixture_count,state_count=conf.state_count,embed_dim=conf.embed_dim,device=conf.device)
@@ -130,6 +134,15 @@ def init_conf(CUDA):
     #     state_count=conf.state_count,embed_dim=conf.embed_dim,device=conf.device)
 
 
+    conf.reinforce = sys.argv[sys.argv.index('--reinforce')+1] if '--reinforce' in sys.argv else None
+    if conf.reinforce:
+        ### REINFORCE estimator of log_prob_grad, trained on instead of log_prob
+        assert hasattr(model,'reinforce'),f'{model.__class__.__name__} does not sample'
+        model.reinforce = conf.reinforce
+    if conf.var_len:
+        ### log_prob runs n_step steps, set to each batch's width
+        assert hasattr(model,'n_step'),f'{model.__class__.__name__} has a fixed length'
+
     params = list(model.parameters())
     print(dict(model.named_parameters()).keys())
     #### using Adam with high learning_rate is catastrophic
@@ -137,6 +150,17 @@ def init_conf(CUDA):
     conf.optimizer = torch.optim.RMSprop( params, lr=conf.learning_rate)
     return conf
 
+def token_mean(lp,lengths=None):
+    '''
+    Mean of the per-token log-probs lp, shape of (B,L), over the first
+    lengths positions of each row if given, else over all of them
+    '''
+    if lengths is None:
+        return lp.mean()
+    assert lp.dim()==2,f'expected per-token log-probs, got shape {tuple(lp.shape)}'
+    valid = torch.arange(lp.size(1),device=lp.device)[None] < lengths.to(lp.device)[:,None]
+    return (lp*valid).sum()/valid.sum().clamp(min=1)
+
 def main():
     CUDA = 1
     conf = init_conf(CUDA)
@@ -205,7 +229,9 @@ def main():
             x    = item['english']
             zi   = item['index']
             # print(zi.min())
-            loss =  -model.log_prob(zi,x).mean()
+            lengths = item.get('english_length') if conf.var_len else None
+            if conf.var_len: model.n_step = x.size(1)
+            loss =  -token_mean(model.log_prob(zi,x),lengths)
             loss_test_sum +=  float(loss.item())
             if tsi==conf.tsi_max:
                 break
@@ -222,11 +248,14 @@ def main():
             # print(zi.min())
             # z = model.encode(x)
             # y = model.decode(z)
-            gradloss =  -model.log_prob_grad(zi,x).mean()
-            loss =  -model.log_prob(zi,x).mean()
+            lengths = item.get('english_length') if conf.var_len else None
+            if conf.var_len: model.n_step = x.size(1)
+            kw   = dict(ids=item['sentence_id']) if conf.reinforce else {}
+            gradloss =  -token_mean(model.log_prob_grad(zi,x,**kw),lengths)
+            loss =  -token_mean(model.log_prob(zi,x),lengths)
             # loss.mean()
             loss_train_sum += float(loss.item())
-            loss.backward()
+            (gradloss if conf.reinforce else loss).backward()
             conf.optimizer.step()
             # break
 
@@ -3,6 +3,7 @@ import sys,os
 
 import torch
 from train import init_conf
+from markov_lm.util_sample import sample_categorical
 import numpy as np
 def main():
     conf = init_conf(CUDA=0)
@@ -45,10 +46,7 @@ def main():
     lat    = lat / (0.00001 + lat.std(-1,keepdims=True)) *0.113
 
     n_sample = 20
-    xp = tokens.softmax(-1)[:,None].repeat((1,n_sample,1,1))
-    xpc = xp.cumsum(-1)
-    val,which = (torch.rand(xp.shape[:-1])[:,:,:,None]<xpc).max(-1)
-    sample = which
+    sample = sample_categorical(tokens,n=n_sample).permute(0,2,1)
     for xx in  sample[4][2]: print(repr(conf.dataset.english_vocab_reversed[xx]),end=':')
     for xx in  sample[4][3]: print(repr(conf.dataset.english_vocab_reversed[xx]),end=':')
     print()
@@ -59,14 +57,14 @@ def main():
     def ptr(i):
         L = len( conf.dataset.english_sentences_train)
         if i<=L-1:
-            for xx in  conf.dataset.english_sentences_train[i]: print(repr(conf.dataset.english_vocab_reversed[xx]),end=':')
+            xs = conf.dataset.english_sentences_train[i]
         else:
-            for xx in  conf.dataset.english_sentences_test[i-L]: print(repr(conf.dataset.english_vocab_reversed[xx]),end=':')
-        print()
+            xs = conf.dataset.english_sentences_test[i-L]
+        print(':'.join(map(repr,conf.dataset.decode(xs,join=False))))
     def getptdr(tokens):
+        words = conf.dataset.decode(tokens,join=False)
         def pdr(i):
-            for xx in  tokens.argmax(-1)[i]: print(repr(conf.dataset.english_vocab_reversed[xx]),end=':')
-            print()
+            print(':'.join(map(repr,words[i])))
         def ptdr(i): [ptr(i),pdr(i)]
         return ptdr
     ptdr = getptdr(tokens)
@@ -5,6 +5,7 @@ import torch.nn.functional as F
 import torch.optim
 
 from markov_lm.Dataset.translation_dataset import EnglishToGermanDataset
+from markov_lm.Dataset.translation_dataset import batch_dataloader
 
 import os,sys
 
@@ -71,8 +72,8 @@ def init_conf(CUDA):
     conf.batch_size = 60
     conf.tsi_max = 10
 
-    conf.dataset = dataset = EnglishToGermanDataset(CUDA=CUDA)
-    conf.dataloader = torch.utils.data.DataLoader(dataset, batch_size=conf.batch_size, shuffle=True)
+    conf.dataset = dataset = EnglishToGermanDataset(CUDA=CUDA,languages=("english",))
+    conf.dataloader = batch_dataloader(dataset, batch_size=conf.batch_size, shuffle=True)
     # dataloader_test = torch.utils.data.DataLoader(dataset, batch_size=conf.batch_size, shuffle=True)
     # conf.model = model = ExtractionAndMarkovTemplateMatching(graph_dim = dataset.english_vocab_len,mixture_count=conf.mixture_count,state_count=conf.state_count,embed_dim=conf.embed_dim,device=conf.device)
     conf.optimizer_factory = torch.optim.RMSprop
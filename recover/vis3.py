@@ -38,14 +38,14 @@ def main():
     def ptr(i):
         L = len( conf.dataset.english_sentences_train)
         if i<=L-1:
-            for xx in  conf.dataset.english_sentences_train[i]: print(repr(conf.dataset.english_vocab_reversed[xx]),end=':')
+            xs = conf.dataset.english_sentences_train[i]
         else:
-            for xx in  conf.dataset.english_sentences_test[i-L]: print(repr(conf.dataset.english_vocab_reversed[xx]),end=':')
-        print()
+            xs = conf.dataset.english_sentences_test[i-L]
+        print(':'.join(map(repr,conf.dataset.decode(xs,join=False))))
     def getptdr(tokens):
+        words = conf.dataset.decode(tokens,join=False)
         def pdr(i):
-            for xx in  tokens.argmax(-1)[i]: print(repr(conf.dataset.english_vocab_reversed[xx]),end=':')
-            print()
+            print(':'.join(map(repr,words[i])))
         def ptdr(i):
             if i <0:
                 return
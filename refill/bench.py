@@ -0,0 +1,496 @@
+'''
+Parity checks and timings for the refill models, run on random batches.
+
+    python bench.py steps  [--L 15,60,240]
+    python bench.py sweeps [--L 15,60,240]
+    python bench.py context [--L 15,60,240]
+    python bench.py vocab  [--L 15,60,240]
+    python bench.py parallel [--L 15,60,240]
+    python bench.py compile [--L 15,60,240]
+    python bench.py trace  [--L 15,60,240]
+    python bench.py forward_all [--L 15,60,240]
+    python bench.py checkerboard [--L 15,60,240]
+    python bench.py reservoir [--L 15,60,240]
+    python bench.py sampling
+    python bench.py reinforce [--L 15,60,240]
+    python bench.py transitions [--L 15,60,240]
+    python bench.py adaptive [--L 15,60,240]
+    python bench.py markov [--L 15,60,240]
+
+Each section compares a fast path against the reference path it replaces
+(same parameters, same seed), asserts that outputs and gradients agree and
+prints their max abs differences, then timings. A failed check raises, so
+the script exits non-zero; test_bench.py runs every section on short
+sequences.
+'''
+import sys,time,math,inspect
+import torch
+
+from markov_lm.Model_Refill import RefillModelRNNAdditive
+from markov_lm.Model_Refill import RefillModelRNNAdditiveDirect
+from markov_lm.Model_Refill import RefillModelRNNAdditiveDirectSampling
+from markov_lm.Model_Refill import RefillModelRNNAdditiveDirectMixing
+from markov_lm.Model_Refill import RefillModelRNNAdditiveDirectMixingWithGate
+from markov_lm.Model_Refill import RefillModelRNNAdditiveWithPseudoSampling
+from markov_lm.Model_Refill import RefillModelRNNAttention
+from markov_lm.Model_Refill import RefillModelNGRAM
+from markov_lm.Model_Refill import RefillModelRNNGRU
+from markov_lm.Model_Refill import RefillModelRNNAdditiveDirectMixingBidirectional
+from markov_lm.Model_Refill import RefillModelRNNAdditiveDirectMixingBidirectionalFixedEmission
+from markov_lm.Model_Refill import RefillModelRNNAdditiveDirectMixingWithAttention
+from markov_lm.Model_Refill import RefillModelRNNAdditiveSweeping
+from markov_lm.Model_Refill import RefillModelRNNAdditiveSweepingWithResidual
+from markov_lm.Model_Refill import RefillModelMixtureRNNSweepingOldEmission
+from markov_lm.Model_Refill import RefillModelMixtureRNNSweepingOldEmissionDifferentTransition
+from markov_lm.Model_Refill import RefillModelMixtureRNNSweepingNewEmission
+from markov_lm.Model_Refill import TraceRecorder
+from markov_lm.Model import RNNWithMarkovNet
+from markov_lm.util_sample import sample_categorical
+
+STEP_MODELS = [
+    RefillModelRNNAdditive,
+    RefillModelRNNAdditiveDirect,
+    RefillModelRNNAdditiveDirectSampling,
+    RefillModelRNNAdditiveDirectMixing,
+    RefillModelRNNAdditiveDirectMixingWithGate,
+    RefillModelRNNAdditiveWithPseudoSampling,
+    RefillModelRNNAttention,
+    RefillModelNGRAM,
+    RefillModelRNNGRU,
+]
+
+SWEEP_MODELS = [
+    RefillModelRNNAdditiveDirectMixingBidirectional,
+    RefillModelRNNAdditiveDirectMixingBidirectionalFixedEmission,
+    RefillModelRNNAdditiveDirectMixingWithAttention,
+    RefillModelRNNAdditiveSweeping,
+    RefillModelRNNAdditiveSweepingWithResidual,
+    RefillModelMixtureRNNSweepingOldEmission,
+    RefillModelMixtureRNNSweepingOldEmissionDifferentTransition,
+    RefillModelMixtureRNNSweepingNewEmission,
+]
+
+def make_model(cls,V=200,E=16,K=8,L=15,seed=0):
+    ### the mixture models take fewer constructor arguments
+    kw = dict(device=torch.device('cpu'),graph_dim=V,embed_dim=E,mixture_count=K,
+        state_count=5,total_length=100,min_len=L,mask_token_idx=V-1)
+    names = inspect.signature(cls.__init__).parameters
+    torch.manual_seed(seed)
+    return cls(**{k:v for k,v in kw.items() if k in names})
+
+def make_batch(B=8,L=15,V=200,n_mask=4,seed=0):
+    g = torch.Generator()
+    g.manual_seed(seed)
+    x = torch.randint(2,V-1,(B,L),generator=g)
+    idx = torch.rand((B,L),generator=g).topk(n_mask,-1)[1]
+    y = torch.gather(x,-1,idx)
+    z = x.scatter(-1,idx,V-1)
+    return torch.arange(B),x,y,z
+
+def run(model,batch,out='loss',seed=0):
+    '''
+    Returns (output, {name:grad}) of one forward/backward
+    '''
+    return run_fn(model,lambda:model._loss(*batch,out=out),seed)
+
+def run_fn(model,f,seed=0):
+    model.zero_grad()
+    torch.manual_seed(seed)
+    v = f()
+    v.float().mean().backward()
+    grads = {k:p.grad.clone() for k,p in model.named_parameters() if p.grad is not None}
+    return v.detach(),grads
+
+def max_diff(a,b):
+    va,ga = a
+    vb,gb = b
+    dg = max([(ga[k]-gb[k]).abs().max().item() for k in ga] or [0.])
+    return (va-vb).abs().max().item(),dg
+
+def timeit(f,n=3):
+    f()
+    t0 = time.time()
+    for _ in range(n): f()
+    return (time.time()-t0)/n
+
+def saved_bytes(f):
+    '''
+    Bytes of the tensors autograd saves for backward while running f()
+    '''
+    total = [0]
+    def pack(t):
+        total[0] += t.numel()*t.element_size()
+        return t
+    with torch.autograd.graph.saved_tensors_hooks(pack,lambda t:t):
+        f()
+    return total[0]
+
+def step_flops(model,batch):
+    '''
+    (forward FLOPs per _step call, number of calls) of one model.loss()
+    '''
+    from torch.utils.flop_counter import FlopCounterMode
+    n = [0]
+    def count(outer,inner):
+        n[0] += 1
+    model.callback_step = count
+    try:
+        with FlopCounterMode(display=False) as fc:
+            model.loss(*batch)
+    finally:
+        del model.callback_step
+    return fc.get_total_flops()/max(n[0],1),n[0]
+
+def count_steps(model,batch):
+    '''
+    Number of _step calls of one model.get_tokens()
+    '''
+    n = [0]
+    def count(outer,inner):
+        n[0] += 1
+    model.callback_step = count
+    try:
+        model.get_tokens(*batch)
+    finally:
+        del model.callback_step
+    return n[0]
+
+def with_attr(model,name,value,f):
+    old = getattr(model,name)
+    setattr(model,name,value)
+    try:
+        return f()
+    finally:
+        setattr(model,name,old)
+
+def check_parity(model,flag,fn,values=(False,True),rtol=1e-4,atol=1e-5):
+    '''
+    Runs fn() -> (output, {name:grad}) with model.<flag> set to each of
+    values, reference first, and asserts both agree to rtol/atol.
+    Returns (d_out, d_grad, t_ref, t_new)
+    '''
+    ref = lambda: with_attr(model,flag,values[0],fn)
+    new = lambda: with_attr(model,flag,values[1],fn)
+    (va,ga),(vb,gb) = ref(),new()
+    name = f'{model.__class__.__name__}.{flag}={values[1]!r}'
+    assert ga.keys()==gb.keys(),f'{name}: gradients of {sorted(ga.keys()^gb.keys())} only on one side'
+    d_out,d_grad = max_diff((va,ga),(vb,gb))
+    assert torch.allclose(va,vb,rtol,atol) and all(torch.allclose(ga[k],gb[k],rtol,atol) for k in ga),\
+        f'{name}: d_out={d_out:.2e} d_grad={d_grad:.2e}'
+    return d_out,d_grad,timeit(ref),timeit(new)
+
+def bench_steps(Ls):
+    '''
+    StepOutputs buffering vs torch.cat on every step
+    '''
+    print('[steps] model  L  d_out  d_grad  t_cat  t_buffered')
+    for cls in STEP_MODELS:
+        for L in Ls:
+            model = make_model(cls,L=L)
+            batch = make_batch(L=L)
+            d_out,d_grad,t0,t1 = check_parity(model,'buffered_steps',lambda:run(model,batch))
+            print(f'{cls.__name__} {L} {d_out:.2e} {d_grad:.2e} {t0:.4f} {t1:.4f}')
+
+def bench_sweeps(Ls):
+    '''
+    SweepSlots vs torch.scatter into full (B,L,...) tensors
+    '''
+    print('[sweeps] model  L  d_out  d_grad  MB_scatter  MB_slots  t_scatter  t_slots')
+    for cls in SWEEP_MODELS:
+        for L in Ls:
+            model = make_model(cls,L=L)
+            batch = make_batch(L=L)
+            d_out,d_grad,t0,t1 = check_parity(model,'slot_sweeps',lambda:run(model,batch))
+            mb = [saved_bytes(lambda: with_attr(model,'slot_sweeps',v,lambda:model.loss(*batch)))/2**20 for v in (False,True)]
+            print(f'{cls.__name__} {L} {d_out:.2e} {d_grad:.2e} {mb[0]:.1f} {mb[1]:.1f} {t0:.4f} {t1:.4f}')
+
+def bench_context(Ls):
+    '''
+    BatchContext caching vs recomputing y-only keys/candidates every step
+    '''
+    print('[context] model  L  steps  d_out  d_grad  flops/step_recompute  flops/step_cached  t_recompute  t_cached')
+    for cls in STEP_MODELS+SWEEP_MODELS:
+        for L in Ls:
+            model = make_model(cls,L=L)
+            batch = make_batch(L=L)
+            d_out,d_grad,t0,t1 = check_parity(model,'batch_context',lambda:run(model,batch))
+            (f0,n),(f1,_) = [with_attr(model,'batch_context',v,lambda:step_flops(model,batch)) for v in (False,True)]
+            print(f'{cls.__name__} {L} {n} {d_out:.2e} {d_grad:.2e} {f0:.3g} {f1:.3g} {t0:.4f} {t1:.4f}')
+
+def bench_vocab(Ls):
+    '''
+    Cached z/y vocab log-probs vs projecting every candidate each step
+    '''
+    print('[vocab] model  L  steps  d_out  d_grad  flops/step_full  flops/step_cached  t_full  t_cached')
+    for cls in [RefillModelRNNAdditiveDirectMixing,RefillModelRNNAdditiveDirectMixingWithGate]+SWEEP_MODELS:
+        for L in Ls:
+            model = make_model(cls,L=L)
+            batch = make_batch(L=L)
+            d_out,d_grad,t0,t1 = check_parity(model,'cache_vocab_logp',lambda:run(model,batch))
+            (f0,n),(f1,_) = [with_attr(model,'cache_vocab_logp',v,lambda:step_flops(model,batch)) for v in (False,True)]
+            print(f'{cls.__name__} {L} {n} {d_out:.2e} {d_grad:.2e} {f0:.3g} {f1:.3g} {t0:.4f} {t1:.4f}')
+
+def bench_parallel(Ls):
+    '''
+    _forward_parallel vs the step loop
+    '''
+    print('[parallel] model  L  d_out  d_grad  t_loop  t_parallel')
+    for cls in [RefillModelRNNAdditive,RefillModelRNNAdditiveWithPseudoSampling,RefillModelNGRAM]:
+        for L in Ls:
+            model = make_model(cls,L=L)
+            batch = make_batch(L=L)
+            d_out,d_grad,t0,t1 = check_parity(model,'parallel_forward',lambda:run(model,batch))
+            print(f'{cls.__name__} {L} {d_out:.2e} {d_grad:.2e} {t0:.4f} {t1:.4f}')
+
+def bench_compile(Ls):
+    '''
+    compile_steps=True vs eager _step, timed after the first (compiling) call
+    '''
+    print('[compile] model  L  d_out  d_grad  t_eager  t_compiled  speedup')
+    for cls in STEP_MODELS+SWEEP_MODELS:
+        for L in Ls:
+            model = make_model(cls,L=L)
+            model.parallel_forward = False
+            batch = make_batch(L=L)
+            ### fused kernels reorder the float sums
+            d_out,d_grad,t0,t1 = check_parity(model,'compile_steps',lambda:run(model,batch),rtol=1e-3,atol=1e-4)
+            print(f'{cls.__name__} {L} {d_out:.2e} {d_grad:.2e} {t0:.4f} {t1:.4f} {t0/t1:.2f}x')
+
+def bench_trace(Ls):
+    '''
+    Forward time with no callback, a no-op callback and a TraceRecorder
+    '''
+    print('[trace] model  L  t_none  t_noop  t_trace  MB_trace')
+    for cls in STEP_MODELS+SWEEP_MODELS:
+        for L in Ls:
+            model = make_model(cls,L=L)
+            batch = make_batch(L=L)
+            B = len(batch[0])
+            f = lambda: model.get_tokens(*batch)
+            n = count_steps(model,batch)
+            rec = TraceRecorder().attach(model)
+            f()
+            rec.detach(model)
+            vals = rec.tensors()
+            assert (rec.n,rec.T)==(B,n),f'{cls.__name__}: recorded {rec.n} samples of {rec.T} steps, expected {B} of {n}'
+            assert all(v.shape[:2]==(n,B) for k,v in vals.items() if k!='pos') and vals['pos'].shape==(n,)
+
+            t0 = timeit(f)
+            model.callback_step = lambda outer,inner: None
+            t1 = timeit(f)
+            del model.callback_step
+            rec = TraceRecorder().attach(model)
+            t2 = timeit(f)
+            mb = sum(v.numel()*v.element_size() for v in rec.tensors().values())/2**20
+            rec.detach(model)
+            print(f'{cls.__name__} {L} {t0:.4f} {t1:.4f} {t2:.4f} {mb:.1f}')
+
+def bench_forward_all(Ls):
+    '''
+    forward_all() vs grad_loss() followed by loss(), as the trainer did
+    '''
+    print('[forward_all] model  L  d_loss  d_grad_loss  t_two_pass  t_forward_all')
+    for cls in STEP_MODELS+SWEEP_MODELS:
+        for L in Ls:
+            model = make_model(cls,L=L)
+            batch = make_batch(L=L)
+            def ref():
+                torch.manual_seed(0)
+                g = model.grad_loss(*batch)
+                torch.manual_seed(0)
+                return model.loss(*batch),g
+            def new():
+                torch.manual_seed(0)
+                outs = model.forward_all(*batch,outputs=('loss','grad_loss'))
+                return outs['loss'],outs['grad_loss']
+            (l0,g0),(l1,g1) = ref(),new()
+            d_l,d_g = (l0-l1).abs().max().item(),(g0-g1).abs().max().item()
+            assert torch.allclose(l0,l1,1e-4,1e-5) and torch.allclose(g0,g1,1e-4,1e-5),f'{cls.__name__}: d_loss={d_l:.2e} d_grad_loss={d_g:.2e}'
+            print(f'{cls.__name__} {L} {d_l:.2e} {d_g:.2e} {timeit(ref):.4f} {timeit(new):.4f}')
+
+CHECKERBOARD_MODELS = [
+    RefillModelRNNAdditiveDirectMixingBidirectional,
+    RefillModelMixtureRNNSweepingOldEmission,
+    RefillModelMixtureRNNSweepingOldEmissionDifferentTransition,
+    RefillModelMixtureRNNSweepingNewEmission,
+]
+
+def fit(model,batch,n_iter=50,lr=0.01):
+    '''
+    Losses of the first and last of n_iter Adam steps on one batch
+    '''
+    opt = torch.optim.Adam(model.parameters(),lr=lr)
+    losses = []
+    for _ in range(n_iter):
+        opt.zero_grad()
+        loss = model.loss(*batch).mean()
+        loss.backward()
+        opt.step()
+        losses.append(loss.item())
+    return losses[0],losses[-1]
+
+def bench_checkerboard(Ls):
+    '''
+    Red-black schedule vs the sequential sweeps: forward/backward time and
+    the loss reached by fitting the same initial model to one batch
+    '''
+    print('[checkerboard] model  L  t_sequential  t_checkerboard  loss0  fit_sequential  fit_checkerboard')
+    for cls in CHECKERBOARD_MODELS:
+        for L in Ls:
+            batch = make_batch(L=L)
+            res = {}
+            for schedule in ('sequential','checkerboard'):
+                model = make_model(cls,L=L)
+                model.sweep_schedule = schedule
+                t = timeit(lambda:run(model,batch))
+                res[schedule] = (t,)+fit(model,batch)
+            (t0,l0,f0),(t1,_,f1) = res['sequential'],res['checkerboard']
+            assert all(math.isfinite(v) for v in (l0,f0,f1)),f'{cls.__name__}: non-finite loss {l0} {f0} {f1}'
+            print(f'{cls.__name__} {L} {t0:.4f} {t1:.4f} {l0:.3f} {f0:.3f} {f1:.3f}')
+
+def bench_reservoir(Ls):
+    '''
+    DirectSampling with K chains at once vs in checkpointed chunks of 100
+    '''
+    print('[reservoir] L  K  chunk  loss  MB_saved  t_forward_backward')
+    for L in Ls:
+        for K in (100,1000):
+            for chunk in (None,100):
+                model = make_model(RefillModelRNNAdditiveDirectSampling,L=L)
+                model.K,model.chain_chunk = K,chunk
+                batch = make_batch(L=L)
+                f  = lambda: model.forward_all(*batch,outputs=('loss','grad_loss'))['grad_loss'].mean().backward()
+                mb = saved_bytes(f)/2**20
+                v  = model.loss(*batch).mean().item()
+                assert math.isfinite(v),f'K={K} chain_chunk={chunk}: loss {v}'
+                print(f'{L} {K} {chunk} {v:.3f} {mb:.1f} {timeit(f):.4f}')
+
+def sample_cumsum(logits,n):
+    ### the inverse-CDF pattern util_sample replaced
+    xpc = logits.softmax(-1)[...,None,:].expand(*logits.shape[:-1],n,logits.size(-1)).cumsum(-1)
+    _,xi = (torch.rand(xpc.shape[:-1]+(1,))<=xpc).max(-1)
+    return xi
+
+def bench_sampling(Ls):
+    '''
+    sample_categorical (gumbel, multinomial) vs cumsum+rand+max, timing and
+    max abs difference of the empirical frequencies from softmax(logits),
+    each row's frequencies and their mean over rows, which must vanish
+    '''
+    print('[sampling] rows  V  n  method  max_freq_err  mean_freq_err  t')
+    torch.manual_seed(0)
+    for rows,V,n in [(800,9,100),(800,200,20),(100,5000,10)]:
+        logits = torch.randn((rows,V))
+        p = logits.softmax(-1)
+        for name,f in [('cumsum',lambda: sample_cumsum(logits,n)),
+                       ('gumbel',lambda: sample_categorical(logits,n=n)),
+                       ('multinomial',lambda: sample_categorical(logits,n=n,method='multinomial'))]:
+            xi = f()
+            assert xi.shape==(rows,n) and 0<=xi.min() and xi.max()<V
+            freq = torch.zeros_like(p).scatter_add_(-1,xi,torch.ones(xi.shape))/n
+            err  = (freq-p).mean(0).abs().max().item()
+            assert err < 0.01,f'{name} rows={rows} V={V} n={n}: mean frequency error {err:.3f}'
+            print(f'{rows} {V} {n} {name} {(freq-p).abs().max().item():.3f} {err:.4f} {timeit(f):.5f}')
+
+def reinforce_grads(model,batch,R=8):
+    '''
+    (R,P) flattened gradients of -grad_loss over R sampling seeds
+    '''
+    gs = []
+    for seed in range(R):
+        model.zero_grad()
+        torch.manual_seed(seed)
+        (-model.forward_all(*batch,outputs=('grad_loss',))['grad_loss'].mean()).backward()
+        gs.append(torch.cat([p.grad.reshape(-1) for p in model.parameters() if p.grad is not None]))
+    return torch.stack(gs,0)
+
+def bench_reinforce(Ls):
+    '''
+    Gradient variance across sampling seeds of the DirectSampling
+    REINFORCE estimators, and cosine of their mean to that of loo at K=100
+    '''
+    print('[reinforce] L  estimator  K  grad_var  cos_to_ref  t')
+    for L in Ls:
+        model = make_model(RefillModelRNNAdditiveDirectSampling,L=L)
+        batch = make_batch(L=L)
+        model.K,model.reinforce = 100,'loo'
+        ref = reinforce_grads(model,batch).mean(0)
+        for est in ('none','loo','ema'):
+            for K in (10,100):
+                model.K,model.reinforce = K,est
+                model.reward_baseline.seen[:] = False
+                t0 = time.time()
+                gs = reinforce_grads(model,batch)
+                t  = (time.time()-t0)/len(gs)
+                assert gs.isfinite().all(),f'{est} K={K}: non-finite gradients'
+                cos = torch.nn.functional.cosine_similarity(gs.mean(0),ref,dim=0).item()
+                print(f'{L} {est} {K} {gs.var(0).mean().item():.3e} {cos:.3f} {t:.4f}')
+
+def bench_transitions(Ls):
+    '''
+    DifferentTransition with bmm transitions computed once per step vs the
+    broadcast (B,1,K,E,E) product recomputed for xss and xe, K=3..32
+    '''
+    cls = RefillModelMixtureRNNSweepingOldEmissionDifferentTransition
+    print('[transitions] L  K  d_out  d_grad  MB_broadcast  MB_bmm  t_broadcast  t_bmm')
+    for L in Ls:
+        for K in (3,8,16,32):
+            model = make_model(cls,K=K,L=L,E=32)
+            batch = make_batch(L=L)
+            d_out,d_grad,t0,t1 = check_parity(model,'bmm_transitions',lambda:run(model,batch))
+            mb = [saved_bytes(lambda: with_attr(model,'bmm_transitions',v,lambda:model.loss(*batch)))/2**20 for v in (False,True)]
+            print(f'{L} {K} {d_out:.2e} {d_grad:.2e} {mb[0]:.1f} {mb[1]:.1f} {t0:.4f} {t1:.4f}')
+
+def bench_adaptive(Ls):
+    '''
+    Adaptive sweeps that never converge (sweep_tol<0) and stop at the fixed
+    sweep count must match the fixed schedule. Then fixed vs max_sweeps=6
+    with per-row freezing, after a short fit so that rows can converge:
+    loss, average sweeps per row and inference time
+    '''
+    print('[adaptive] model  L  tol  loss_fixed  loss_adaptive  sweeps_fixed  sweeps_adaptive  t_fixed  t_adaptive')
+    for cls in SWEEP_MODELS:
+        for L in Ls:
+            model = make_model(cls,L=L)
+            batch = make_batch(L=L)
+            model.sweep_stats(reset=True)
+            model.loss(*batch)
+            n_fixed = round(model.sweep_stats(reset=True)[1])
+            with_attr(model,'sweep_tol',-1.,lambda:check_parity(model,'max_sweeps',lambda:run(model,batch),values=(None,n_fixed)))
+
+            fit(model,batch,n_iter=20)
+            model.eval()
+            with torch.no_grad():
+                for tol in (1e-2,1e-3):
+                    res = []
+                    for max_sweeps in (None,6):
+                        model.max_sweeps,model.sweep_tol = max_sweeps,tol
+                        model.sweep_stats(reset=True)
+                        v = model.loss(*batch).mean().item()
+                        n = model.sweep_stats(reset=True)[1]
+                        res.append((v,n,timeit(lambda:model.loss(*batch))))
+                    (v0,n0,t0),(v1,n1,t1) = res
+                    assert n1<=6 and math.isfinite(v1),f'{cls.__name__} tol={tol}: {n1:.2f} sweeps, loss {v1}'
+                    print(f'{cls.__name__} {L} {tol} {v0:.4f} {v1:.4f} {n0:.2f} {n1:.2f} {t0:.4f} {t1:.4f}')
+            model.max_sweeps = None
+
+def bench_markov(Ls):
+    '''
+    RNNWithMarkovNet trajectories by repeated squaring (markov_powers) vs
+    the att.matmul(xtran) loop, through log_prob
+    '''
+    print('[markov] L  d_out  d_grad  t_loop  t_powers')
+    for L in Ls:
+        model = make_model(RNNWithMarkovNet,L=L)
+        zi,x,y,z = make_batch(L=L)
+        d_out,d_grad,t0,t1 = check_parity(model,'parallel_trajectory',lambda:run_fn(model,lambda:model.log_prob(zi,x)))
+        print(f'{L} {d_out:.2e} {d_grad:.2e} {t0:.4f} {t1:.4f}')
+
+sections = dict(steps=bench_steps,sweeps=bench_sweeps,context=bench_context,vocab=bench_vocab,parallel=bench_parallel,compile=bench_compile,trace=bench_trace,forward_all=bench_forward_all,checkerboard=bench_checkerboard,reservoir=bench_reservoir,sampling=bench_sampling,reinforce=bench_reinforce,transitions=bench_transitions,adaptive=bench_adaptive,markov=bench_markov)
+
+if __name__=='__main__':
+    Ls = [15,60,240]
+    if '--L' in sys.argv:
+        Ls = [int(v) for v in sys.argv[sys.argv.index('--L')+1].split(',')]
+    for name in (sys.argv[1:2] if sys.argv[1:2] and sys.argv[1] in sections else sections):
+        sections[name](Ls)
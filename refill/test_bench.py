@@ -0,0 +1,65 @@
+'''
+Runs every bench.py section on short sequences. Each section asserts that
+its fast path matches the reference path it replaced.
+'''
+import pytest
+pytest.importorskip('torch')
+import bench
+
+@pytest.mark.parametrize('name',sorted(bench.sections))
+def test_section(name):
+    bench.sections[name]([15])
+
+def test_direct_sampling_grad_loss():
+    ### grad_loss() is the REINFORCE surrogate, not the plain loss
+    import torch
+    model = bench.make_model(bench.RefillModelRNNAdditiveDirectSampling)
+    batch = bench.make_batch()
+    torch.manual_seed(0)
+    g = model.grad_loss(*batch)
+    torch.manual_seed(0)
+    outs = model.forward_all(*batch,outputs=('loss','grad_loss'))
+    assert torch.allclose(g,outs['grad_loss'])
+    assert not torch.allclose(g,outs['loss'])
+
+def test_forward_all_lengths():
+    ### full lengths change nothing, shorter ones drop the padded tail
+    import torch
+    model = bench.make_model(bench.RefillModelRNNAdditive)
+    zi,x,y,z = bench.make_batch()
+    L = x.size(1)
+    full = model.forward_all(zi,x,y,z,outputs=('loss',),lengths=torch.full((len(x),),L))['loss']
+    assert torch.allclose(full,model.loss(zi,x,y,z))
+    lengths = torch.randint(1,L+1,(len(x),))
+    masked = model.forward_all(zi,x,y,z,outputs=('loss',),lengths=lengths)['loss']
+    lp = model.target_energy(model.get_tokens(zi,x,y,z),x)
+    ref = torch.stack([-lp[i,:n].mean() for i,n in enumerate(lengths.tolist())])
+    assert torch.allclose(masked,ref,1e-4,1e-5)
+
+PAD_MODELS = bench.SWEEP_MODELS+[m for m in bench.STEP_MODELS if m is not bench.RefillModelRNNAdditiveDirectSampling]
+
+@pytest.mark.parametrize('schedule',['sequential','checkerboard'])
+@pytest.mark.parametrize('cls',PAD_MODELS,ids=lambda c:c.__name__)
+def test_forward_all_padding(cls,schedule):
+    ### every row of a padded batch gives what it gives on its own, unpadded
+    import torch
+    if schedule=='checkerboard' and getattr(cls,'_step_colour',None) is None:
+        pytest.skip('sequential sweeps only')
+    model = bench.make_model(cls)
+    model.sweep_schedule = schedule
+    zi,x,y,z = bench.make_batch()
+    (B,L),n_mask = x.shape,y.size(1)
+    g = torch.Generator()
+    g.manual_seed(1)
+    lengths = torch.randint(n_mask,L+1,(B,),generator=g)
+    lengths[0] = L
+    pad = torch.arange(L) >= lengths[:,None]
+    x = x.masked_fill(pad,1)
+    idx = (torch.rand((B,L),generator=g)-pad.float()).topk(n_mask,-1)[1]
+    y = torch.gather(x,-1,idx)
+    z = x.scatter(-1,idx,199)   ### mask_token_idx of make_model()
+    outs = model.forward_all(zi,x,y,z,outputs=('loss','token'),lengths=lengths)
+    for b,n in enumerate(lengths.tolist()):
+        ref = model.forward_all(zi[b:b+1],x[b:b+1,:n],y[b:b+1],z[b:b+1,:n],outputs=('loss','token'))
+        assert torch.allclose(outs['loss'][b:b+1],ref['loss'],1e-4,1e-5)
+        assert torch.allclose(outs['token'][b:b+1,:n],ref['token'],1e-4,1e-5)
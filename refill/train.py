@@ -6,6 +6,7 @@ import torch.optim
 
 # from markov_lm.Dataset.translation_dataset import EnglishToGermanDataset
 from markov_lm.Dataset.translation_dataset import RefillDataset
+from markov_lm.Dataset.translation_dataset import batch_dataloader
 
 import os,sys
 
@@ -95,11 +96,18 @@ def init_conf(CUDA,shuffle):
     conf.batch_size = 60
     conf.tsi_max = 10
 
-    conf.dataset = dataset = RefillDataset(CUDA=CUDA)
+    ### --mask_schedule <file>: fixed masks shared by every model, see write_mask_schedule()
+    mask_schedule = sys.argv[sys.argv.index('--mask_schedule')+1] if '--mask_schedule' in sys.argv else None
+    ### --var_len: sentences at their true length, batched by length and
+    ### with the padding left out of the loss and unseen by the sweeps
+    conf.var_len = '--var_len' in sys.argv
+    conf.dataset = dataset = RefillDataset(CUDA=CUDA,mask_schedule=mask_schedule,var_len=conf.var_len)
     ### test dataset works
     (conf.dataset[range(5)])
 
-    conf.dataloader = torch.utils.data.DataLoader(dataset, batch_size=conf.batch_size, shuffle=shuffle)
+    ### --workers N: CPU-only, corpus in shared memory, persistent workers
+    conf.num_workers = int(sys.argv[sys.argv.index('--workers')+1]) if '--workers' in sys.argv else 0
+    conf.dataloader = batch_dataloader(dataset, batch_size=conf.batch_size, shuffle=shuffle, bucket=conf.var_len, num_workers=conf.num_workers)
     # dataloader_test = torch.utils.data.DataLoader(dataset, batch_size=conf.batch_size, shuffle=True)
     # conf.model = model = ExtractionAndMarkovTemplateMatching(graph_dim = dataset.english_vocab_len,mixture_count=conf.mixture_count,state_count=conf.state_count,embed_dim=conf.embed_dim,device=conf.device)
     conf.optimizer_factory = None
@@ -179,6 +187,24 @@ def init_conf(CUDA,shuffle):
     # conf.model = model = RefillModelCopyWithRandomFill(total_length=dataset.total_length(),min_len=dataset.min_len,graph_dim = dataset.english_vocab_len,mixture_count=conf.mixture_count,
     #     state_count=conf.state_count,embed_dim=conf.embed_dim,device=conf.device,mask_token_idx=dataset.english_vocab['<mask>'])
     ### 180_0.1007
+    if '--compile' in sys.argv:
+        ### torch.compile the per-position _step, eager fallback if unsupported.
+        ### Export TORCHINDUCTOR_CACHE_DIR (outside the repo) to reuse kernels
+        model.compile_steps = True
+    if '--checkerboard' in sys.argv:
+        ### red-black parallel sweeps for the ICM models that support them
+        model.sweep_schedule = 'checkerboard'
+    if '--max_sweeps' in sys.argv:
+        ### stop sweeping each sentence once it changes less than --sweep_tol
+        assert '--checkerboard' not in sys.argv,'--max_sweeps only applies to sequential sweeps'
+        model.max_sweeps = int(sys.argv[sys.argv.index('--max_sweeps')+1])
+        if '--sweep_tol' in sys.argv:
+            model.sweep_tol = float(sys.argv[sys.argv.index('--sweep_tol')+1])
+    conf.reinforce = sys.argv[sys.argv.index('--reinforce')+1] if '--reinforce' in sys.argv else None
+    if conf.reinforce:
+        ### train the sampling models on their REINFORCE objective (grad_loss)
+        assert hasattr(model,'reinforce'),f'{model.__class__.__name__} does not sample'
+        model.reinforce = conf.reinforce
 
     params = list(model.parameters())
     print(dict(model.named_parameters()).keys())
@@ -231,8 +257,8 @@ def main():
     loss_test_mean = 0
     n_mask = 4
     for _epoch in range(conf.num_epoch):
-        conf.dataset.op_extract_and_mask(n_mask)
         epoch += 1
+        conf.dataset.op_extract_and_mask(n_mask,epoch)
         loss_train_sum = 0
         loss_test_sum = 0
 
@@ -261,7 +287,8 @@ def main():
             y    = item['extracted']
             z    = item['masked']
             # print(zi.min())
-            loss = model.loss(zi,x,y,z).mean()
+            kw   = dict(lengths=item['english_length']) if conf.var_len else {}
+            loss = model.forward_all(zi,x,y,z,outputs=('loss',),**kw)['loss'].mean()
             loss_test_sum +=  float(loss.item())
             if tsi==conf.tsi_max:
                 break
@@ -280,11 +307,15 @@ def main():
             # print(zi.min())
             # z = model.encode(x)
             # y = model.decode(z)
-            gradloss = model.grad_loss(zi,x,y,z).mean()
-            loss =  model.loss(zi,x,y,z).mean()
+            ### one forward pass for both outputs
+            kw   = dict(lengths=item['english_length']) if conf.var_len else {}
+            if conf.reinforce: kw['ids'] = item['sentence_id']
+            outs = model.forward_all(zi,x,y,z,outputs=('loss','grad_loss'),**kw)
+            gradloss = outs['grad_loss'].mean()
+            loss =  outs['loss'].mean()
             # loss.mean()
             loss_train_sum += float(loss.item())
-            loss.backward()
+            (-gradloss if conf.reinforce else loss).backward()
             conf.optimizer.step()
             # break
 
@@ -295,6 +326,8 @@ def main():
         print(f'ModelClassName: {conf.model.__class__.__name__}')
         print(f'Training Loss: {loss_train_mean}')
         print(f'Testing Loss: {loss_test_mean}')
+        if getattr(model,'sweep_rows',0):
+            print(f'Average Sweeps: {model.sweep_stats(reset=True)[1]:.2f}')
 
         train_losses.append(loss_train_mean)
         test_losses.append(loss_test_mean)
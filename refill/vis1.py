@@ -27,8 +27,10 @@ def main():
 
 
     dbg = 0
-    xx = torch.cat([item['english'] for item in tqdm(conf.dataloader)],dim=0)
-    clup = torch.cat([model.log_prob_cluster(item['english'],dbg) for item in tqdm(conf.dataloader)],dim=0)
+    ### one pass over the data, sentences are fetched back by index when printed
+    idxs,clup = zip(*[(item['index'],model.log_prob_cluster(item['english'],dbg)) for item in tqdm(conf.dataloader)])
+    idxs = torch.cat(idxs,dim=0)
+    clup = torch.cat(clup,dim=0)
     # clup = torch.cat([model.log_prob(item['english']) for item in tqdm(conf.dataloader)],dim=0)
     # clup = torch.cat(clup,dim=0)[:,:,0]
     x = clup.exp()
@@ -53,13 +55,18 @@ def main():
     sel = (clup[:,idx]>cutoff)
     print(sel.sum())
     def mapper(xi,conf=conf):return conf.dataset.english_vocab_reversed[xi]
-    for xxx in xx[sel][:10]: print(':'.join(map(mapper,xxx)))
+    xx = conf.dataset[idxs[sel][:20]]['english']
+    for xxx in xx[:10]: print(':'.join(map(mapper,xxx)))
 
 
-    for xxx in xx[sel][:20]:
+    for xxx in xx[:20]:
         res = [];
         for xi in xxx:  res.append(conf.dataset.english_vocab_reversed[xi])
 
+    ### corpus queries go through the cached inverted index, e.g. at the prompt:
+    ###   ids,xs = conf.dataset.containing('the','cat',n=10); conf.dataset.decode(xs)
+    ###   conf.dataset.token_index().duplicates()
+
 
     # def log_prob_cluster(self,x):
     if 1:
@@ -32,16 +32,12 @@ def main():
 
     print('[TRYING]')
     def idx2word(i): return conf.dataset.english_vocab_reversed[i]
-    def seqs_to_printer(seqs_of_seqs,L=10,mapper=conf.dataset.english_vocab_reversed):
+    def seqs_to_printer(seqs_of_seqs,L=10,language="english"):
+        ### decode every row in one go, printing only formats
+        words = [conf.dataset.decode(seqs,language,join=False) for seqs in seqs_of_seqs]
         def printer(i):
-            for seqs in seqs_of_seqs:
-                for xx in  seqs[i]:
-                    v = mapper.__getitem__(int(xx))
-                    v = (v + ' '*(L-len(v)))[:L]
-                    print(v,end=':')
-                    # print(repr(mapper.__getitem__(xx)),end=':')
-                    # mapper(int(xx))
-                print()
+            for ws in words:
+                print(''.join(f'{v:<{L}.{L}}:' for v in ws[i]))
 
         return printer
 
@@ -75,11 +71,15 @@ def main():
     conf.model.callback_step = callback
     # def callback(s, inner ): print(wlen(idx2word(conf.model.vocab(inner[2][0:1]).argmax(-1)[0]),10),end=' : '); print((inner[1][0,:,:10]*100).long())
     conf.model.callback_step = callback
+    if '--trace' in sys.argv:
+        ### record sel/xs/xp into arrays instead of printing every step
+        from markov_lm.Model_Refill import TraceRecorder
+        conf.model.__dict__.pop('callback_step')
+        rec = TraceRecorder().attach(conf.model)
 
     outs = []
     xs   = []
     ts   = []
-    ts = torch.tensor([],requires_grad=True)
     for i in range(2):
         if i==0:
             # conf.dataset.train()
@@ -89,12 +89,16 @@ def main():
         for item in (conf.dataloader):
             out = model.get_tokens(item['index'],item['english'],item['extracted'],item['masked'])
             xs.append(item['masked'])
-            ts = torch.cat([ts,item['english']],dim=0)
+            ts.append(item['english'])
             outs.append(out)
 
     xs  = torch.cat(xs,dim=0)
+    ts  = torch.cat(ts,dim=0)
     xrs = torch.cat(outs,dim=0)
     # ptdr,ptr,pdr = getptdr
+    if '--trace' in sys.argv:
+        prefix = f"trace_{conf.model.__class__.__name__}_{epoch}"
+        print(rec.save(prefix))
     printer = seqs_to_printer([ts,xrs.argmax(-1),xs],L=7)
     for i in range(20):printer(i);print()
     # for i in range(20): ptdr(i);print()
@@ -0,0 +1,132 @@
+'''
+Categorical sampling over the last dim, shared by the models and vis scripts
+in place of the hand-written cumsum/rand/max pattern.
+'''
+import torch
+
+def filter_logits(logits,top_k=None,top_p=None):
+    '''
+    Sets to -inf every logit outside the top_k largest, and outside the
+    smallest set whose probability reaches top_p (nucleus).
+    '''
+    if top_k is not None and top_k < logits.size(-1):
+        kth = logits.topk(top_k,dim=-1)[0][...,-1:]
+        logits = logits.masked_fill(logits < kth,-float('inf'))
+    if top_p is not None and top_p < 1.:
+        val,idx = logits.sort(-1,descending=True)
+        cp = val.softmax(-1).cumsum(-1)
+        ### keep a token if the mass before it is still below top_p
+        drop = (cp - val.softmax(-1)) >= top_p
+        drop = drop.scatter(-1,idx,drop)
+        logits = logits.masked_fill(drop,-float('inf'))
+    return logits
+
+def sample_categorical(logits=None,probs=None,n=None,temperature=1.,top_k=None,top_p=None,generator=None,method='gumbel'):
+    '''
+    Draws indices from the categorical distributions along the last dim.
+
+    :type logits: shape of (...,V), log-space and possibly unnormalised
+    :type probs:  shape of (...,V), given instead of logits
+    :param n: number of draws per distribution, adds a trailing dim of size n
+    :param temperature: logits are divided by it, 0 returns the argmax
+    :param generator: torch.Generator for the noise, on the device of logits
+    :param method: 'gumbel' takes argmax(logits + Gumbel noise), 'multinomial'
+        calls torch.multinomial, cheaper when n is large.
+    :return: LongTensor of shape (...) or (...,n)
+    '''
+    if logits is None:
+        logits = probs.log()
+    if temperature == 0:
+        idx = logits.argmax(-1)
+        return idx if n is None else idx[...,None].expand(*idx.shape,n)
+    if temperature != 1.:
+        logits = logits / temperature
+    logits = filter_logits(logits,top_k,top_p).detach()
+    shape,V = logits.shape[:-1],logits.size(-1)
+
+    if method == 'multinomial':
+        p   = logits.reshape((-1,V)).softmax(-1)
+        idx = torch.multinomial(p,1 if n is None else n,replacement=True,generator=generator)
+        return idx.reshape(shape) if n is None else idx.reshape(shape+(n,))
+    elif method == 'gumbel':
+        if n is not None:
+            logits = logits[...,None,:]
+        noise = torch.empty(shape+(() if n is None else (n,))+(V,),dtype=logits.dtype,device=logits.device)
+        ### -log(Exp(1)) is Gumbel(0,1) distributed
+        noise = -noise.exponential_(generator=generator).log()
+        return (logits + noise).argmax(-1)
+    else:
+        raise Exception(f'Unknown method={method}')
+
+def reinforce_objective(reward,lp,estimator='none',baseline=None,dim=-1):
+    '''
+    Surrogate objective (to maximise) whose gradient estimates that of
+    E[reward], from samples along dim with log-probabilities lp.
+
+    :type reward: differentiable, broadcasts with lp
+    :param estimator:
+        'none' reward*lp, the plain estimate the models used so far
+        'loo'  pathwise term plus score term with the leave-one-out mean
+               of the other samples' rewards as baseline
+        'ema'  same with a given baseline, e.g. RunningBaseline
+    '''
+    if estimator == 'none':
+        return reward*lp
+    r = reward.detach()
+    if estimator == 'loo':
+        K = r.size(dim)
+        b = (r.sum(dim,keepdims=True) - r)/max(K-1,1)
+    elif estimator == 'ema':
+        b = baseline.detach()
+    else:
+        raise Exception(f'Unknown estimator={estimator}')
+    return reward + (r-b)*lp
+
+class RunningBaseline(torch.nn.Module):
+    '''
+    Per-example running mean of the reward, a baseline learned online for
+    reinforce_objective(estimator='ema'). Held in non-persistent buffers,
+    so state_dict and checkpoints are unchanged.
+
+    Examples are keyed by an id over the whole dataset, so that train and
+    test sentences never share a slot. A reward with position dims keeps a
+    value per position, and the table grows to the longest batch seen, so
+    batches of different lengths (var_len) keep their baselines.
+    '''
+    def __init__(self,n,momentum=0.9):
+        super().__init__()
+        self.n = n
+        self.momentum = momentum
+        self.register_buffer('value',torch.zeros((n,)),persistent=False)
+        self.register_buffer('seen',torch.zeros((n,),dtype=torch.bool),persistent=False)
+
+    def _fit(self,shape):
+        ### grows the table to hold the trailing dims shape, keeping its values
+        if self.value.dim()-1 != len(shape):
+            self.value = self.value.new_zeros((self.n,)+shape)
+            self.seen  = self.seen.new_zeros((self.n,)+shape)
+            return
+        new = tuple(max(a,b) for a,b in zip(self.value.shape[1:],shape))
+        if new == tuple(self.value.shape[1:]):
+            return
+        old = (slice(None),)+tuple(slice(0,a) for a in self.value.shape[1:])
+        value = self.value.new_zeros((self.n,)+new)
+        seen  = self.seen.new_zeros((self.n,)+new)
+        value[old] = self.value
+        seen[old]  = self.seen
+        self.value,self.seen = value,seen
+
+    def forward(self,idx,reward):
+        '''
+        Baseline of the examples idx (B,), shape of reward (B,...,K) with
+        K set to 1, then updates them with the mean reward over K. Only
+        updated in training mode, call .eval() for the test set.
+        '''
+        r = reward.detach().mean(-1)
+        self._fit(tuple(r.shape[1:]))
+        sl = (idx,)+tuple(slice(0,a) for a in r.shape[1:])
+        b = torch.where(self.seen[sl],self.value[sl],r)
+        if self.training:
+            self.value[sl] = self.momentum*b + (1-self.momentum)*r
+            self.seen[sl]  = True
+        return b[...,None]